@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+## -*- python -*-
+
+## batch converter for KiwiSDR IQ .wav files with GNSS timestamps
+##
+## converts all given files (or all .wav files in the given directories) using
+## a pool of worker processes; the file format is handled by read_kiwi_iq_wav.py
+##
+## output formats, written to --output-dir as [name].*
+##  iq:       raw interleaved int16 IQ samples as stored in the .wav file
+##  npy:      complex64 IQ samples (scaled as in read_kiwi_iq_wav) in a .npy file
+##  segments: complex64 .npy files [name]_[GNSS second].npy, one per --segment-sec
+##            seconds on the GNSS time scale
+## for each file [name].json holds the sample timing fitted to the GNSS time
+## stamps (see KiwiIQWavReader.timing) and, for segments, the list of segments
+
+import glob
+import json
+import logging
+import math
+import multiprocessing
+import os
+import struct
+import sys
+import time
+import numpy as np
+
+from optparse import OptionParser
+from read_kiwi_iq_wav import KiwiIQWavReader, KiwiIQWavError, FLAG_NO_GPS, FLAG_OUTLIER
+
+def _output_base(options, filename):
+    name = os.path.splitext(os.path.basename(filename))[0]
+    return os.path.join(options.output_dir or os.path.dirname(filename), name)
+
+def _write_iq(reader, base):
+    with open(base + '.iq', 'wb') as f:
+        for i in range(len(reader)):
+            reader.block_iq(i).tofile(f)
+
+def _write_npy(reader, n0, n1, filename):
+    if n1 <= n0:
+        np.save(filename, np.zeros(0, dtype=np.complex64))
+        return
+    ## the samples go straight from the mapped input to the mapped output
+    out = np.lib.format.open_memmap(filename, mode='w+', dtype=np.complex64, shape=(n1-n0,))
+    reader.read_iq(n0, n1, out)
+    out.flush()
+    del out
+
+def _write_segments(reader, timing, base, segment_sec):
+    n = reader.num_samples()
+    segments = []
+    if n == 0:
+        return segments
+    ## a sample less than eps seconds before a segment boundary belongs to
+    ## the next segment: otherwise rounding of the fitted time stamps can
+    ## produce a spurious segment holding a single sample
+    eps = 1e-6
+    k0 = int(math.floor((timing.time(0)   + eps) / segment_sec))
+    k1 = int(math.floor((timing.time(n-1) + eps) / segment_sec))
+    for k in range(k0, k1+1):
+        t  = k*segment_sec
+        n0 = min(max(timing.sample_index(t - eps), 0), n)
+        n1 = min(max(timing.sample_index(t + segment_sec - eps), n0), n)
+        if n1 == n0:
+            continue
+        filename = '%s_%d.npy' % (base, t)
+        _write_npy(reader, n0, n1, filename)
+        segments.append({'file': os.path.basename(filename),
+                         't0': float(timing.time(n0)),
+                         'num_samples': n1-n0})
+    return segments
+
+def convert_file(filename, options):
+    """Converts one file, returns (number of samples, number of bytes read)"""
+    reader = KiwiIQWavReader(filename, use_index_cache=not options.no_index_cache)
+    try:
+        timing = reader.timing()
+        base   = _output_base(options, filename)
+        n      = reader.num_samples()
+        info   = {'source':             os.path.basename(filename),
+                  'format':             options.format,
+                  'samplerate':         timing.samplerate,
+                  'nominal_samplerate': reader.get_samplerate(),
+                  't0':                 float(timing.time(0)),
+                  'num_samples':        n,
+                  'num_blocks':         len(reader),
+                  'no_gps_blocks':      int(np.count_nonzero(timing.flags & FLAG_NO_GPS)),
+                  'outlier_blocks':     int(np.count_nonzero(timing.flags & FLAG_OUTLIER)),
+                  'rms_us':             timing.rms()*1e6}
+        if options.format == 'iq':
+            _write_iq(reader, base)
+        elif options.format == 'npy':
+            _write_npy(reader, 0, n, base + '.npy')
+        else:
+            info['segments'] = _write_segments(reader, timing, base, options.segment_sec)
+        with open(base + '.json', 'w') as f:
+            json.dump(info, f, indent=1)
+    finally:
+        reader.close()
+    return n, 4*n
+
+def _convert_file(args):
+    ## pool worker: exceptions are returned as strings so that one bad file
+    ## does not stop the batch
+    filename, options = args
+    t = time.time()
+    try:
+        n, nbytes = convert_file(filename, options)
+        return filename, n, nbytes, time.time() - t, None
+    except (KiwiIQWavError, IOError, OSError, ValueError, struct.error) as e:
+        return filename, 0, 0, time.time() - t, '%s' % e
+
+def find_input_files(args):
+    files = []
+    for arg in args:
+        if os.path.isdir(arg):
+            files.extend(sorted(glob.glob(os.path.join(arg, '*.wav'))))
+        else:
+            files.append(arg)
+    return files
+
+def main():
+    parser = OptionParser(usage='%prog [options] [directory|file.wav] ...')
+    parser.add_option('-f', '--format',
+                      dest='format', type='choice', default='npy',
+                      choices=['iq', 'npy', 'segments'],
+                      help='Output format: iq (raw int16) | npy (complex64, default) | segments (complex64 .npy per --segment-sec)')
+    parser.add_option('-o', '--output-dir', '--output_dir',
+                      dest='output_dir', type='string', default=None,
+                      help='Output directory (default: next to the input files)')
+    parser.add_option('--segment-sec', '--segment_sec',
+                      dest='segment_sec', type='int', default=60,
+                      help='Segment length (sec, GNSS time) for --format=segments (default 60)')
+    parser.add_option('-j', '--jobs',
+                      dest='jobs', type='int', default=multiprocessing.cpu_count(),
+                      help='Number of worker processes (default: number of CPUs)')
+    parser.add_option('--no-index-cache', '--no_index_cache',
+                      dest='no_index_cache', default=False, action='store_true',
+                      help='Do not read or write the [file].idx.npz index caches')
+    parser.add_option('--log', '--log-level', '--log_level', type='choice',
+                      dest='log_level', default='info',
+                      choices=['debug', 'info', 'warn', 'error', 'critical'],
+                      help='Log level: debug|info(default)|warn|error|critical')
+
+    (options, args) = parser.parse_args()
+    if not args:
+        parser.error('no input files or directories')
+    if options.segment_sec <= 0:
+        parser.error('--segment-sec must be positive')
+
+    FORMAT = '%(asctime)-15s pid %(process)5d %(message)s'
+    logging.basicConfig(level=logging.getLevelName(options.log_level.upper()), format=FORMAT)
+
+    files = find_input_files(args)
+    if options.output_dir and not os.path.isdir(options.output_dir):
+        os.makedirs(options.output_dir)
+
+    jobs = [(fn, options) for fn in files]
+    t_start = time.time()
+    total_samples = total_bytes = failed = 0
+    if options.jobs > 1 and len(files) > 1:
+        pool = multiprocessing.Pool(min(options.jobs, len(files)))
+        results = pool.imap_unordered(_convert_file, jobs)
+    else:
+        pool = None
+        results = (_convert_file(job) for job in jobs)
+    try:
+        for k,(filename, n, nbytes, dt, error) in enumerate(results):
+            if error is not None:
+                failed += 1
+                logging.error('[%d/%d] %s: %s' % (k+1, len(files), filename, error))
+                continue
+            total_samples += n
+            total_bytes   += nbytes
+            logging.info('[%d/%d] %s: %.2f Msamples in %.2f s (%.1f MB/s)'
+                         % (k+1, len(files), filename, n*1e-6, dt, nbytes*1e-6/max(dt, 1e-6)))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    dt = time.time() - t_start
+    logging.info('%d files (%d failed), %.2f Msamples in %.2f s: %.2f Msamples/s, %.1f MB/s'
+                 % (len(files), failed, total_samples*1e-6, dt,
+                    total_samples*1e-6/max(dt, 1e-6), total_bytes*1e-6/max(dt, 1e-6)))
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
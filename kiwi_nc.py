@@ -1,71 +1,195 @@
 #!/usr/bin/env python
 ## -*- python -*-
 
-import array, logging, os, struct, sys, time, copy, threading, os
+import json, logging, os, struct, sys, time, copy, threading, os
 import gc
 import numpy as np
 
+from collections import deque
 from copy import copy
 from traceback import print_exc
-from kiwiclient import KiwiSDRStream
+from kiwiclient import KiwiSDRStream, Squelch, waterfall_stats
 from kiwiworker import KiwiWorker
 from optparse import OptionParser
 
-class RingBuffer(object):
-    def __init__(self, len):
-        self._array = np.zeros(65, dtype='float')
-        self._index = 0
-        self._is_filled = False
-
-    def insert(self, sample):
-        self._array[self._index] = sample;
-        self._index += 1
-        if self._index == len(self._array):
-            self._is_filled = True;
-            self._index = 0
-
-    def is_filled(self):
-        return self._is_filled
-
-    def median(self):
-        return np.median(self._array)
-
-
-class Squelch(object):
-    def __init__(self, options):
-        self._status_msg  = False
-        self._threshold   = options.thresh
-        self._tail_delay  = round(options.squelch_tail*12000/512) ## seconds to number of buffers
-        self._ring_buffer = RingBuffer(65)
-        self._squelch_on_seq = None
-
-    def process(self, seq, rssi):
-        if not self._ring_buffer.is_filled() or self._squelch_on_seq is None:
-            self._ring_buffer.insert(rssi)
-        if not self._ring_buffer.is_filled():
-            return False
-        median_nf   = self._ring_buffer.median()
-        rssi_thresh = median_nf + self._threshold
-        is_open     = self._squelch_on_seq is not None
-        if is_open:
-            rssi_thresh -= 6
-        rssi_green = rssi >= rssi_thresh
-        if rssi_green:
-            self._squelch_on_seq = seq
-            is_open = True
-        if self._status_msg:
-            sys.stdout.write('\r Median: %6.1f Thr: %6.1f %s' % (median_nf, rssi_thresh, ("s", "S")[is_open]))
-            sys.stdout.flush()
-        if not is_open:
-            return False
-        if seq > self._squelch_on_seq + self._tail_delay:
-            logging.info("\nSquelch closed")
-            self._squelch_on_seq = None
-            return False
-        return is_open
+class KiwiStdoutSink(object):
+    """Buffered binary output to a file descriptor, drained by a writer thread.
+
+    The websocket threads only append blocks to a queue; a dedicated thread
+    writes them out with os.writev, i.e. without concatenating the blocks.
+    Flush policies:
+      immediate   write as soon as data is queued (interactive use)
+      bytes       write when at least flush_bytes are queued
+      time        write when the oldest queued block is flush_interval sec old
+    In any case the queue is written when half of max_buffer is reached.
+    A slow consumer fills the queue instead of stalling the websocket
+    threads; when max_buffer is reached, write() waits at most block_timeout
+    sec for room and then drops the block (counted, with a rate-limited
+    warning), so that the Kiwi does not time out the connection. The wait
+    happens once per stall: until the writer thread frees space again,
+    further blocks that do not fit are dropped without waiting.
+    On a write error (e.g. EPIPE when the consumer has gone) the error is
+    logged once, on_error is called and all further data is discarded.
+    """
+
+    IOV_MAX = 1024
+
+    def __init__(self, fd, policy='immediate', flush_bytes=65536, flush_interval=0.1,
+                 max_buffer=16<<20, block_timeout=1.0, on_error=None):
+        self._fd             = fd
+        self._policy         = policy
+        self._flush_bytes    = flush_bytes
+        self._flush_interval = flush_interval
+        self._max_buffer     = max_buffer
+        self._block_timeout  = block_timeout
+        self._on_error       = on_error
+        self._items    = deque()   ## (timestamp, block)
+        self._pending  = 0         ## bytes queued or being written
+        self._cond     = threading.Condition()
+        self._closing  = False
+        self._failed   = False
+        self._stalled  = False     ## a write() timed out and no space was freed since
+        self._num_written  = 0
+        self._num_dropped  = 0
+        self._bytes_dropped = 0
+        self._last_warning = 0
+        self._thread = threading.Thread(target=self._run, name='stdout-sink')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def write(self, data):
+        ## a flat byte view of the block, whatever its sample type
+        block = np.frombuffer(data, dtype=np.uint8)
+        if len(block) == 0:
+            return
+        with self._cond:
+            if self._failed:
+                self._bytes_dropped += len(block)
+                return
+            if self._closing:
+                return
+            if self._pending + len(block) > self._max_buffer and self._pending > 0:
+                deadline = time.time() + self._block_timeout
+                while self._pending + len(block) > self._max_buffer and self._pending > 0 \
+                        and not self._failed:
+                    dt = deadline - time.time()
+                    if self._stalled or dt <= 0:
+                        self._stalled        = True
+                        self._num_dropped   += 1
+                        self._bytes_dropped += len(block)
+                        self._warn_dropped()
+                        return
+                    self._cond.wait(dt)
+                if self._failed:
+                    return
+            self._items.append((time.time(), block))
+            self._pending += len(block)
+            self._cond.notify_all()
+
+    def _warn_dropped(self):
+        now = time.time()
+        if now - self._last_warning >= 10:
+            self._last_warning = now
+            logging.warn('stdout: consumer too slow, %d blocks (%d bytes) dropped so far'
+                         % (self._num_dropped, self._bytes_dropped))
+
+    def _wait_ready(self):
+        """Called with the lock held; returns the blocks to write, or None to stop"""
+        while True:
+            if self._items:
+                if self._closing or self._policy == 'immediate' or self._pending >= self._max_buffer//2:
+                    break
+                if self._policy == 'bytes' and self._pending >= self._flush_bytes:
+                    break
+                if self._policy == 'time':
+                    dt = self._items[0][0] + self._flush_interval - time.time()
+                    if dt <= 0:
+                        break
+                    self._cond.wait(dt)
+                    continue
+            elif self._closing:
+                return None
+            self._cond.wait()
+        blocks = [block for ts,block in self._items]
+        self._items.clear()
+        return blocks
+
+    def _write_blocks(self, blocks):
+        i = 0
+        while i < len(blocks):
+            iov = blocks[i:i+self.IOV_MAX]
+            if hasattr(os, 'writev'):
+                n = os.writev(self._fd, iov)
+            else:
+                n = os.write(self._fd, iov[0])
+            ## advance over the written blocks; a partially written block is sliced
+            while n > 0:
+                if n >= len(blocks[i]):
+                    n -= len(blocks[i])
+                    i += 1
+                else:
+                    blocks[i] = memoryview(blocks[i])[n:]
+                    n = 0
+
+    def _run(self):
+        while True:
+            with self._cond:
+                blocks = self._wait_ready()
+            if blocks is None:
+                return
+            nbytes = sum(len(b) for b in blocks)
+            try:
+                self._write_blocks(blocks)
+            except (IOError, OSError) as e:
+                self._fail(e)
+            with self._cond:
+                self._pending -= nbytes
+                self._num_written += len(blocks)
+                self._stalled = False
+                self._cond.notify_all()
+
+    def _fail(self, e):
+        with self._cond:
+            if self._failed:
+                return
+            self._failed = True
+            ## the block being written is subtracted from _pending by _run
+            self._bytes_dropped += self._pending
+            self._pending -= sum(len(b) for ts,b in self._items)
+            self._items.clear()
+            self._cond.notify_all()
+        logging.error('stdout: %s; further output is discarded' % e)
+        if self._on_error is not None:
+            self._on_error()
+
+    def close(self, timeout=5.0):
+        """Write all queued blocks and stop the writer thread. If the consumer
+        does not take them within timeout sec, the blocks still queued are
+        discarded and the (daemon) writer thread is left behind."""
+        with self._cond:
+            self._closing = True
+            self._cond.notify_all()
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            with self._cond:
+                ## as in _fail(): the blocks being written count as dropped
+                nbytes = self._pending
+                self._failed = True
+                self._bytes_dropped += nbytes
+                self._pending -= sum(len(b) for ts,b in self._items)
+                self._items.clear()
+            logging.warn('stdout: consumer stalled at exit, %d bytes discarded' % nbytes)
+
+    def metrics(self):
+        with self._cond:
+            return {'pending_bytes': self._pending,
+                    'blocks_written': self._num_written,
+                    'blocks_dropped': self._num_dropped,
+                    'bytes_dropped': self._bytes_dropped}
+
 
 class KiwiNetcat(KiwiSDRStream):
-    def __init__(self, options, reader):
+    def __init__(self, options, reader, sink):
         super(KiwiNetcat, self).__init__()
         self._options = options
         self._type = 'admin' if options.admin is True else ('W/F' if options.waterfall is True else 'SND');
@@ -78,8 +202,8 @@ class KiwiNetcat(KiwiSDRStream):
         self._squelch = Squelch(self._options) if options.thresh is not None else None
         self._num_channels = 2 if options.modulation == 'iq' else 1
         self._last_gps = dict(zip(['last_gps_solution', 'dummy', 'gpssec', 'gpsnsec'], [0,0,0,0]))
-        self._fp_stdout = os.fdopen(sys.stdout.fileno(), 'wb')
-        
+        self._sink = sink
+
     def _setup_rx_params(self):
         self.set_name(self._options.user)
         if self._type == 'SND':
@@ -114,9 +238,16 @@ class KiwiNetcat(KiwiSDRStream):
                     self._start_ts = None
                     self._start_time = None
                     return
+            if self._options.little_endian and not self._compression:
+                samples = self._to_little_endian(samples)
             self._write_samples(samples, {})
 
     def _process_iq_samples_raw(self, seq, samples, rssi, gps):
+        ## samples is the received payload: interleaved big-endian int16 I/Q
+        if self._options.progress is True:
+            sys.stdout.write('\rBlock: %08x, RSSI: %6.1f' % (seq, rssi))
+            sys.stdout.flush()
+            return
         if self._squelch:
             is_open = self._squelch.process(seq, rssi)
             if not is_open:
@@ -125,45 +256,39 @@ class KiwiNetcat(KiwiSDRStream):
                 return
         ##print gps['gpsnsec']-self._last_gps['gpsnsec']
         #self._last_gps = gps
-        ## convert list of complex numbers into an array
-        s = array.array('h')
-        for x in [[y.real, y.imag] for y in samples]:
-            s.extend(map(int, x))
-        self._write_samples(s, gps)
-
         # no GPS or no recent GPS solution
         #last = gps['last_gps_solution']
         #if last == 255 or last == 254:
         #    self._options.status = 3
+        if self._options.little_endian:
+            samples = self._to_little_endian(samples)
+        self._write_samples(samples, gps)
+
+    @staticmethod
+    def _to_little_endian(samples):
+        return np.frombuffer(samples, dtype='>i2').astype('<i2')
 
     def _process_waterfall_samples_raw(self, samples, seq):
+        stats = None
+        if self._options.progress is True or self._options.wf_stats:
+            stats = waterfall_stats(samples) ## None for an empty line
+        if self._options.wf_stats and stats is not None:
+            ## stdout carries the samples, so the records go to stderr
+            stats.update(host=self._options.server_host, seq=seq, ts=time.time())
+            sys.stderr.write(json.dumps(stats, sort_keys=True) + '\n')
+            sys.stderr.flush()
         if self._options.progress is True:
-            nbins = len(samples)
-            bins = nbins-1
-            max = -1
-            min = 256
-            bmax = bmin = 0
-            i = 0
-            for s in samples:
-                if s > max:
-                    max = s
-                    bmax = i
-                if s < min:
-                    min = s
-                    bmin = i
-                i += 1
-            span = 30000
+            if stats is None:
+                return
             sys.stdout.write('\rwf samples %d bins %d..%d dB %.1f..%.1f kHz rbw %d kHz'
-                  % (nbins, min-255, max-255, span*bmin/bins, span*bmax/bins, span/bins))
+                  % (stats['nbins'], stats['min'], stats['max'], stats['f_min'], stats['f_max'], stats['rbw']))
             sys.stdout.flush()
         else:
-            self._fp_stdout.write(samples)
-            self._fp_stdout.flush()
+            self._sink.write(samples)
 
     def _write_samples(self, samples, *args):
         if self._options.progress is False:
-            self._fp_stdout.write(samples)
-            self._fp_stdout.flush()
+            self._sink.write(samples)
 
     def _writer_message(self):
         if self._options.writer_init == False:
@@ -199,9 +324,10 @@ def get_comma_separated_args(option, opt, value, parser, fn):
     setattr(parser.values, option.dest, values)
 ##    setattr(parser.values, option.dest, map(fn, value.split(',')))
 
-def join_threads(nc):
+def join_threads(nc, sink):
     [r._event.set() for r in nc]
-    [t.join() for t in threading.enumerate() if t is not threading.currentThread()]
+    [r.join() for r in nc]
+    sink.close()
 
 def main():
     parser = OptionParser()
@@ -269,6 +395,10 @@ def main():
                       dest='hp_cut',
                       type='float', default=2600,
                       help='Low-pass cutoff frequency, in Hz')
+    parser.add_option('--keepalive-interval', '--keepalive_interval',
+                      dest='keepalive_interval',
+                      type='float', default=1.0,
+                      help='Minimum interval (sec) between keepalives sent on each connection')
     parser.add_option('--tlimit', '--time-limit',
                       dest='tlimit',
                       type='float', default=None,
@@ -289,11 +419,37 @@ def main():
                       action='callback',
                       callback_args=(float,),
                       callback=get_comma_separated_args)
+    parser.add_option('--le', '--little-endian', '--little_endian',
+                      dest='little_endian',
+                      default=False,
+                      action='store_true',
+                      help='Write IQ and uncompressed audio samples as little-endian int16 instead of the big-endian byte order sent by the Kiwi')
+    parser.add_option('--flush',
+                      dest='flush', type='choice', default='immediate',
+                      choices=['immediate', 'bytes', 'time'],
+                      help='When to write the buffered output to stdout: immediate(default)|bytes (every --flush-bytes)|time (every --flush-interval)')
+    parser.add_option('--flush-bytes', '--flush_bytes',
+                      dest='flush_bytes', type='int', default=65536,
+                      help='Output buffer size (bytes) for --flush=bytes (default 65536)')
+    parser.add_option('--flush-interval', '--flush_interval',
+                      dest='flush_interval', type='float', default=0.1,
+                      help='Maximum age (sec) of buffered output for --flush=time (default 0.1)')
+    parser.add_option('--max-buffer', '--max_buffer',
+                      dest='max_buffer', type='int', default=16,
+                      help='Maximum amount of buffered output (MB) when stdout is not read fast enough (default 16)')
+    parser.add_option('--stall-timeout', '--stall_timeout',
+                      dest='stall_timeout', type='float', default=1.0,
+                      help='Maximum time (sec) a connection waits for room in a full output buffer before dropping a block (default 1)')
     parser.add_option('--wf', '--waterfall',
                       dest='waterfall',
                       default=False,
                       action='store_true',
                       help='Process waterfall data instead of audio')
+    parser.add_option('--wf-stats', '--wf_stats',
+                      dest='wf_stats',
+                      default=False,
+                      action='store_true',
+                      help='Write per-line waterfall statistics (levels, percentiles, occupancy) as JSON records to stderr')
     parser.add_option('--admin',
                       dest='admin',
                       default=False, action='store_true',
@@ -309,9 +465,19 @@ def main():
     if options.log_level.upper() == 'DEBUG':
         gc.set_debug(gc.DEBUG_SAVEALL | gc.DEBUG_LEAK | gc.DEBUG_UNCOLLECTABLE)
 
+    KiwiSDRStream.keepalive_scheduler.set_interval(options.keepalive_interval)
+
     run_event = threading.Event()
     run_event.set()
 
+    sink = KiwiStdoutSink(sys.stdout.fileno(),
+                          policy=options.flush,
+                          flush_bytes=options.flush_bytes,
+                          flush_interval=options.flush_interval,
+                          max_buffer=options.max_buffer<<20,
+                          block_timeout=options.stall_timeout,
+                          on_error=run_event.clear)
+
     options.raw = True;
     options.is_kiwi_tdoa = False;
     gopt = options
@@ -321,10 +487,10 @@ def main():
     for i,opt in enumerate(options):
         opt.multiple_connections = multiple_connections;
         opt.idx = 0
-        nc_inst.append(KiwiWorker(args=(KiwiNetcat(opt, True),opt,run_event)))
+        nc_inst.append(KiwiWorker(args=(KiwiNetcat(opt, True, sink),opt,run_event)))
         opt.writer_init = False
         opt.idx = 1
-        nc_inst.append(KiwiWorker(args=(KiwiNetcat(opt, False),opt,run_event)))
+        nc_inst.append(KiwiWorker(args=(KiwiNetcat(opt, False, sink),opt,run_event)))
 
     try:
         for i,r in enumerate(nc_inst):
@@ -336,17 +502,20 @@ def main():
 
         while run_event.is_set():
             time.sleep(.1)
+        join_threads(nc_inst, sink)
 
     except KeyboardInterrupt:
         run_event.clear()
-        join_threads(nc_inst)
+        join_threads(nc_inst, sink)
         print("KeyboardInterrupt: threads successfully closed")
     except Exception as e:
         print_exc()
         run_event.clear()
-        join_threads(nc_inst)
+        join_threads(nc_inst, sink)
         print("Exception: threads successfully closed")
 
+    logging.debug('stdout: %s' % sink.metrics())
+    logging.debug('keepalives sent: %d' % KiwiSDRStream.keepalive_scheduler.count())
     logging.debug('gc %s' % gc.garbage)
 
 if __name__ == '__main__':
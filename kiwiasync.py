@@ -0,0 +1,240 @@
+## -*- python -*-
+
+## asyncio engine for running many KiwiSDR SND/W/F streams in one event loop
+##  * needs python>=3.7
+##  * message processing is done by the KiwiSDRStream objects (recorders)
+##    exactly as with KiwiWorker threads; only the websocket transport and
+##    the KiwiWorker reconnect/too-busy handling are coroutines here
+##  * only reader streams are supported, i.e. no kiwi_nc writer connections
+
+import asyncio
+import base64
+import logging
+import os
+import re
+import struct
+from traceback import print_exc
+
+from mod_pywebsocket import common
+from mod_pywebsocket import util
+from mod_pywebsocket._stream_hybi import create_text_frame
+from mod_pywebsocket._stream_hybi import create_close_frame
+from mod_pywebsocket._stream_hybi import create_closing_handshake_body
+from mod_pywebsocket._stream_hybi import create_pong_frame
+from wsclient import ClientHandshakeError
+from wsclient import _build_method_line, _format_host_header
+from wsclient import _get_mandatory_header, _validate_mandatory_header
+from wsclient import _UPGRADE_HEADER, _CONNECTION_HEADER
+
+from kiwiclient import KiwiTooBusyError
+from kiwiclient import KiwiTimeLimitError
+from kiwiclient import KiwiServerTerminatedConnection
+
+
+async def _handshake(reader, writer, host, port, resource):
+    """WebSocket opening handshake, same request as wsclient.ClientHandshakeProcessor"""
+    key = base64.b64encode(os.urandom(16))
+    fields = [_format_host_header(host, port, False),
+              _UPGRADE_HEADER,
+              _CONNECTION_HEADER,
+              '%s: %s\r\n' % (common.SEC_WEBSOCKET_KEY_HEADER, key.decode()),
+              '%s: %d\r\n' % (common.SEC_WEBSOCKET_VERSION_HEADER, common.VERSION_HYBI_LATEST)]
+    writer.write(_build_method_line(resource) + ''.join(fields).encode() + b'\r\n')
+
+    status_line = (await reader.readline()).decode('latin-1')
+    m = re.match('HTTP/\\d+\\.\\d+ (\\d\\d\\d) .*\r\n', status_line)
+    if m is None:
+        raise ClientHandshakeError('Wrong status line format: %r' % status_line)
+    if m.group(1) != '101':
+        raise ClientHandshakeError('Expected HTTP status code 101 but found %r' % m.group(1))
+
+    fields = {}
+    while True:
+        line = (await reader.readline()).decode('latin-1')
+        if line in ('\r\n', ''):
+            break
+        if ':' not in line:
+            raise ClientHandshakeError('Malformed header line %r' % line)
+        name, value = line.split(':', 1)
+        fields.setdefault(name.strip().lower(), []).append(value.strip())
+
+    _validate_mandatory_header(fields, common.UPGRADE_HEADER, common.WEBSOCKET_UPGRADE_TYPE, False)
+    _validate_mandatory_header(fields, common.CONNECTION_HEADER, common.UPGRADE_CONNECTION_TYPE, False)
+    accept = _get_mandatory_header(fields, common.SEC_WEBSOCKET_ACCEPT_HEADER)
+    expected_accept = base64.b64encode(util.sha1_hash(key + common.WEBSOCKET_ACCEPT_UUID.encode()).digest())
+    if accept.encode() != expected_accept:
+        raise ClientHandshakeError('Invalid %s header: %r (expected: %s)'
+                                   % (common.SEC_WEBSOCKET_ACCEPT_HEADER, accept, expected_accept))
+
+
+class KiwiAsyncStream(object):
+    """WebSocket transport on asyncio streams.
+
+    Provides the part of the mod_pywebsocket Stream interface which
+    KiwiSDRStream uses for sending (send_message, close_connection) and the
+    socket close() method; received messages are returned by the coroutine
+    receive_message(). Outgoing frames are only queued on the transport, so
+    sending never blocks the event loop.
+    """
+
+    def __init__(self, reader, writer, timeout):
+        self._reader = reader
+        self._writer = writer
+        self._timeout = timeout
+        self._fragments = []
+
+    def send_message(self, message, end=True, binary=False):
+        if self._writer.is_closing():
+            return
+        self._writer.write(create_text_frame(message, mask=True))
+
+    def close_connection(self, code=common.STATUS_NORMAL_CLOSURE, reason=''):
+        if self._writer.is_closing():
+            return
+        self._writer.write(create_close_frame(create_closing_handshake_body(code, reason), mask=True))
+
+    def close(self):
+        self._writer.close()
+
+    async def _read(self, length):
+        try:
+            return await asyncio.wait_for(self._reader.readexactly(length), self._timeout)
+        except asyncio.IncompleteReadError:
+            raise KiwiServerTerminatedConnection('server closed the connection unexpectedly')
+        except asyncio.TimeoutError:
+            raise KiwiServerTerminatedConnection('timeout receiving data')
+
+    async def receive_message(self):
+        """Returns the payload of the next text or binary message as bytes,
+        or None when the server sent a close frame"""
+        while True:
+            b0, b1 = await self._read(2)
+            fin, opcode, length = b0 >> 7, b0 & 0xf, b1 & 0x7f
+            if length == 126:
+                length, = struct.unpack('!H', await self._read(2))
+            elif length == 127:
+                length, = struct.unpack('!Q', await self._read(8))
+            if b1 & 0x80:
+                masker  = util.RepeatedXorMasker(await self._read(4))
+                payload = masker.mask(await self._read(length))
+            else:
+                payload = await self._read(length)
+
+            if opcode == common.OPCODE_CLOSE:
+                return None
+            if opcode == common.OPCODE_PING:
+                self._writer.write(create_pong_frame(payload, mask=True))
+                continue
+            if opcode == common.OPCODE_PONG:
+                continue
+            if opcode == common.OPCODE_CONTINUATION:
+                self._fragments.append(payload)
+                if not fin:
+                    continue
+                payload = b''.join(self._fragments)
+                self._fragments = []
+            elif not fin:
+                self._fragments = [payload]
+                continue
+            return payload
+
+
+class KiwiAsyncWorker(object):
+    """Coroutine counterpart of KiwiWorker: connects one recorder, feeds it the
+    received messages and handles reconnects, too-busy and time limits"""
+
+    def __init__(self, args=()):
+        self._recorder, self._options, self._run_event = args
+        self._recorder._reader = True
+        self._start_delay = 0
+
+    def set_start_delay(self, delay):
+        self._start_delay = delay
+
+    def _do_run(self):
+        return self._run_event.is_set()
+
+    async def _wait(self, timeout):
+        ## like threading.Event.wait() in KiwiWorker: returns early when stopped
+        while timeout > 0 and self._do_run():
+            await asyncio.sleep(min(timeout, 0.1))
+            timeout -= 0.1
+
+    async def _connect(self):
+        rec  = self._recorder
+        host = self._options.server_host
+        port = self._options.server_port
+        timeout = self._options.socket_timeout
+        rec._stream_name = rec._type
+        rec.mark_keepalive(None)
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+        try:
+            uri = '/%d/%s' % (self._options.tstamp, rec._type)
+            await asyncio.wait_for(_handshake(reader, writer, host, port, uri), timeout)
+        except:
+            writer.close()
+            raise
+        rec._stream = rec._socket = KiwiAsyncStream(reader, writer, timeout)
+
+    async def run(self):
+        await self._wait(self._start_delay)
+        try:
+            await self._run()
+        finally:
+            self._run_event.clear()   # tell all other workers to stop
+            self._recorder.close()
+
+    async def _run(self):
+        rec = self._recorder
+        while self._do_run():
+            try:
+                await self._connect()
+            except Exception as e:
+                logging.info("Failed to connect, sleeping and reconnecting error='%s'" %e)
+                if self._options.is_kiwi_tdoa:
+                    self._options.status = 1
+                    break
+                await self._wait(15)
+                continue
+
+            try:
+                rec.open()
+                while self._do_run():
+                    received = await rec._stream.receive_message()
+                    if received is None:
+                        raise KiwiServerTerminatedConnection('server closed the connection cleanly')
+                    rec._process_ws_message(received)
+                    rec._check_time_limit()
+            except KiwiServerTerminatedConnection as e:
+                logging.info("%s:%d %s. Reconnecting after 5 seconds"
+                      % (self._options.server_host, self._options.server_port, e))
+                rec.close()
+                rec._start_ts = None ## this makes the recorder to open a new file on restart
+                await self._wait(5)
+                continue
+            except KiwiTooBusyError:
+                logging.info("%s:%d too busy now. Reconnecting after 15 seconds"
+                      % (self._options.server_host, self._options.server_port))
+                if self._options.is_kiwi_tdoa:
+                    self._options.status = 2
+                    break
+                await self._wait(15)
+                continue
+            except KiwiTimeLimitError:
+                break
+            except Exception as e:
+                if self._options.is_kiwi_tdoa:
+                    self._options.status = 1
+                print_exc()
+                break
+
+
+def run_async_workers(workers):
+    """Run all workers in one event loop until every one of them has stopped.
+    The workers' run_event is cleared when the first one stops, as with
+    KiwiWorker threads."""
+
+    async def _main():
+        await asyncio.gather(*[w.run() for w in workers])
+
+    asyncio.run(_main())
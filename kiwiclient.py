@@ -1,9 +1,12 @@
 #!/usr/bin/env python
 
-import array
 import logging
+import math
+from bisect import bisect_left, insort
+from collections import deque
 import socket
 import struct
+import threading
 import time
 import numpy as np
 try:
@@ -55,7 +58,45 @@ def clamp(x, xmin, xmax):
         return xmax
     return x
 
+def _build_adpcm_byte_table():
+    """Precompute, for every (step index, input byte) pair, the two signed
+    differences produced by the low and high nibbles and the step index
+    reached after both nibbles.
+
+    The tables are flattened: entry index*256 + byte. The next-index table
+    is stored pre-multiplied by 256 so it can be used directly as the base
+    of the next lookup.
+    """
+    steps = np.array(stepSizeTable, dtype=np.int64)
+    adjust = np.array(indexAdjustTable, dtype=np.int64)
+    max_index = len(stepSizeTable) - 1
+
+    def nibble(index, code):
+        step = steps[index]
+        diff = step >> 3
+        diff = diff + np.where(code & 1, step >> 2, 0)
+        diff = diff + np.where(code & 2, step >> 1, 0)
+        diff = diff + np.where(code & 4, step, 0)
+        diff = np.where(code & 8, -diff, diff)
+        return diff, np.clip(index + adjust[code], 0, max_index)
+
+    index = np.repeat(np.arange(len(stepSizeTable)), 256)
+    byte  = np.tile(np.arange(256), len(stepSizeTable))
+    diff0, index = nibble(index, byte & 0x0F)
+    diff1, index = nibble(index, byte >> 4)
+    return diff0, diff1, (index * 256).tolist()
+
+_adpcm_diff0, _adpcm_diff1, _adpcm_next = _build_adpcm_byte_table()
+
 class ImaAdpcmDecoder(object):
+    """IMA ADPCM decoder.
+
+    decode() works on a whole SND or W/F payload at once: the only sequential
+    part, the step index walk, is a plain Python loop over the input bytes
+    doing one table lookup each; the sample differences are then gathered and
+    integrated with NumPy. The decoder state (index, prev) is carried across
+    calls and the output is bit-identical to _decode_sample().
+    """
     def __init__(self):
         self.index = 0
         self.prev = 0
@@ -77,14 +118,41 @@ class ImaAdpcmDecoder(object):
         return sample
 
     def decode(self, data):
-        fcn = ord if isinstance(data, str) else lambda x : x
-        samples = array.array('h')
-        for b in map(fcn, data):
-            sample0 = self._decode_sample(b & 0x0F)
-            sample1 = self._decode_sample(b >> 4)
-            samples.append(sample0)
-            samples.append(sample1)
-        return samples
+        data = np.frombuffer(data, dtype=np.uint8)
+        if len(data) == 0:
+            return np.zeros(0, dtype=np.int16)
+
+        ## walk the step index through the byte table
+        keys = []
+        append = keys.append
+        table_next = _adpcm_next
+        k = self.index * 256
+        for b in data.tolist():
+            k += b
+            append(k)
+            k = table_next[k]
+        self.index = k // 256
+
+        diff = np.empty(2*len(data), dtype=np.int64)
+        diff[0::2] = _adpcm_diff0[keys]
+        diff[1::2] = _adpcm_diff1[keys]
+
+        ## integrate the differences; once a sample has to be clamped (rare in
+        ## practice) the running sum is no longer valid and the rest of the
+        ## block is integrated sample by sample
+        s = self.prev + np.cumsum(diff)
+        clipped = np.flatnonzero((s < -32768) | (s > 32767))
+        if len(clipped) == 0:
+            self.prev = int(s[-1])
+            return s.astype(np.int16)
+        k = clipped[0]
+        samples = s[:k].tolist()
+        prev = int(s[k-1]) if k > 0 else self.prev
+        for d in diff[k:].tolist():
+            prev = clamp(prev + d, -32768, 32767)
+            samples.append(prev)
+        self.prev = prev
+        return np.array(samples, dtype=np.int16)
 
 #
 # KiwiSDR WebSocket client
@@ -103,18 +171,158 @@ class KiwiTimeLimitError(KiwiError):
 class KiwiServerTerminatedConnection(KiwiError):
     pass
 
+## SND/W/F frame headers; all unpacked in place from a memoryview of the message
+_snd_header   = struct.Struct('<BI')    ## flags, seq
+_snd_smeter   = struct.Struct('>H')     ## smeter (big-endian!)
+_snd_iq_gps   = struct.Struct('<BBII')  ## last_gps_solution, dummy, gpssec, gpsnsec
+_wf_header    = struct.Struct('<III')   ## x_bin_server, flags_x_zoom_server, seq
+_SND_DATA_OFFSET = _snd_header.size + _snd_smeter.size
+_IQ_DATA_OFFSET  = _SND_DATA_OFFSET + _snd_iq_gps.size
+
+## monotonic clock if available (python3), else wall clock
+_monotonic = getattr(time, 'monotonic', time.time)
+
+class KiwiKeepaliveScheduler(object):
+    """Rate limiter for 'SET keepalive' messages.
+
+    One instance is shared by all streams of a process. Each stream keeps its
+    own time of the last keepalive, so every connection is still refreshed at
+    least once per interval, but not once per received SND or W/F frame.
+    """
+
+    def __init__(self, interval=1.0):
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._count = 0
+
+    def set_interval(self, interval):
+        self.interval = interval
+
+    def is_due(self, stream):
+        return stream.keepalive_due(_monotonic(), self.interval)
+
+    def record(self, stream):
+        stream.mark_keepalive(_monotonic())
+        with self._lock:
+            self._count += 1
+
+    def count(self):
+        """Number of keepalives sent by all streams of this process"""
+        return self._count
+
+def waterfall_stats(samples, span=30000, percentiles=(10, 90), occupancy_db=10):
+    """Statistics of one waterfall line: samples are uint8 (dB+255) bins,
+    given as a numpy array or a bytes-like object.
+
+    Returns a dict with the min/max level (dB) and the frequencies (kHz) of
+    the bins where they occur, the median level taken as the noise floor, the
+    requested percentiles (dB), and the occupancy, i.e. the fraction of bins
+    more than occupancy_db above the noise floor. Levels are computed from a
+    histogram of the 256 possible values, so the line is scanned only once.
+    Returns None for an empty line.
+    """
+    if not isinstance(samples, np.ndarray):
+        samples = np.frombuffer(samples, dtype=np.uint8)
+    nbins = len(samples)
+    if nbins == 0:
+        return None
+    bins  = max(1, nbins-1)
+    bmin  = int(np.argmin(samples))
+    bmax  = int(np.argmax(samples))
+    cdf   = np.cumsum(np.bincount(samples, minlength=256))
+    ## value at a given rank (nearest-rank percentile)
+    level = lambda q: int(np.searchsorted(cdf, max(1, int(math.ceil(q*nbins/100.0))))) - 255
+    stats = {'nbins':  nbins,
+             'rbw':    float(span)/bins,
+             'min':    int(samples[bmin]) - 255,
+             'max':    int(samples[bmax]) - 255,
+             'f_min':  float(span)*bmin/bins,
+             'f_max':  float(span)*bmax/bins,
+             'median': level(50)}
+    for q in percentiles:
+        stats['p%g' % q] = level(q)
+    threshold = min(255, stats['median'] + 255 + occupancy_db)
+    stats['occupancy'] = float(nbins - cdf[threshold])/nbins
+    return stats
+
+class RollingMedian(object):
+    """Median of the last n values (e.g. the noise floor seen by Squelch).
+
+    The window is kept both in arrival order (to know which value drops out)
+    and sorted; each insert is a binary search plus a list insert/delete of
+    one element, instead of re-sorting the window for every median."""
+
+    def __init__(self, n):
+        self._n = n
+        self._window = deque()
+        self._sorted = []
+
+    def insert(self, value):
+        if len(self._window) == self._n:
+            del self._sorted[bisect_left(self._sorted, self._window.popleft())]
+        self._window.append(value)
+        insort(self._sorted, value)
+
+    def is_filled(self):
+        return len(self._window) == self._n
+
+    def median(self):
+        k = len(self._sorted) // 2
+        if len(self._sorted) % 2:
+            return self._sorted[k]
+        return 0.5*(self._sorted[k-1] + self._sorted[k])
+
+
+class Squelch(object):
+    def __init__(self, options, status_msg=False):
+        self._status_msg  = status_msg
+        self._threshold   = options.thresh
+        self._tail_delay  = round(options.squelch_tail*12000/512) ## seconds to number of buffers
+        self._noise_floor = RollingMedian(65)
+        self._squelch_on_seq = None
+
+    def process(self, seq, rssi):
+        if not self._noise_floor.is_filled() or self._squelch_on_seq is None:
+            self._noise_floor.insert(rssi)
+        if not self._noise_floor.is_filled():
+            return False
+        median_nf   = self._noise_floor.median()
+        rssi_thresh = median_nf + self._threshold
+        is_open     = self._squelch_on_seq is not None
+        if is_open:
+            rssi_thresh -= 6
+        rssi_green = rssi >= rssi_thresh
+        if rssi_green:
+            self._squelch_on_seq = seq
+            is_open = True
+        if self._status_msg:
+            sys.stdout.write('\r Median: %6.1f Thr: %6.1f %s' % (median_nf, rssi_thresh, ("s", "S")[is_open]))
+            sys.stdout.flush()
+        if not is_open:
+            return False
+        if seq > self._squelch_on_seq + self._tail_delay:
+            logging.info("\nSquelch closed")
+            self._squelch_on_seq = None
+            return False
+        return is_open
+
+
 class KiwiSDRStreamBase(object):
     """KiwiSDR WebSocket stream base client."""
 
+    keepalive_scheduler = KiwiKeepaliveScheduler()
+
     def __init__(self):
         self._socket = None
         self._decoder = None
         self._sample_rate = None
         self._isIQ = False
+        self._wf_start = self._wf_zoom = self._wf_flags = 0
         self._version_major = None
         self._version_minor = None
         self._modulation = None
         self._stream = None
+        self._last_keepalive = None
 
     def connect(self, host, port):
         # self._prepare_stream(host, port, 'SND')
@@ -126,6 +334,7 @@ class KiwiSDRStreamBase(object):
 
     def _prepare_stream(self, host, port, which):
         self._stream_name = which;
+        self._last_keepalive = None
         self._socket = socket.create_connection(address=(host, port), timeout=self._options.socket_timeout)
         uri = '/%d/%s' % (self._options.tstamp, which)
         handshake = ClientHandshakeProcessor(self._socket, host, port)
@@ -159,10 +368,25 @@ class KiwiSDRStreamBase(object):
 
     def _set_keepalive(self):
         self._send_message('SET keepalive')
+        self.keepalive_scheduler.record(self)
+
+    def keepalive_due(self, now, interval):
+        """True if no keepalive was sent on this stream in the interval (sec) before now"""
+        return self._last_keepalive is None or now - self._last_keepalive >= interval
+
+    def mark_keepalive(self, now):
+        """Record that a keepalive was sent on this stream at time now (None: none sent yet)"""
+        self._last_keepalive = now
+
+    def _keepalive(self):
+        """Send a keepalive only if this stream's keepalive interval has elapsed"""
+        if self.keepalive_scheduler.is_due(self):
+            self._set_keepalive()
 
     def _process_ws_message(self, message):
-        tag = bytearray2str(message[0:3])
-        body = message[3:]
+        body = memoryview(message)
+        tag = bytearray2str(body[0:3].tobytes())
+        body = body[3:]
         self._process_message(tag, body)
 
 
@@ -267,18 +491,18 @@ class KiwiSDRStream(KiwiSDRStreamBase):
 
     def _process_message(self, tag, body):
         if tag == 'MSG':
-            self._process_msg(bytearray2str(body[1:])) ## skip 1st byte
+            self._process_msg(bytearray2str(body[1:].tobytes())) ## skip 1st byte
         elif tag == 'SND':
             try:
                 self._process_aud(body)
             except Exception as e:
                 logging.error(e)
             # Ensure we don't get kicked due to timeouts
-            self._set_keepalive()
+            self._keepalive()
         elif tag == 'W/F':
             self._process_wf(body[1:]) ## skip 1st byte
             # Ensure we don't get kicked due to timeouts
-            self._set_keepalive()
+            self._keepalive()
         else:
             logging.warn("unknown tag %s" % tag)
             pass
@@ -293,24 +517,24 @@ class KiwiSDRStream(KiwiSDRStreamBase):
                 self._process_msg_param(name, None)
 
     def _process_aud(self, body):
-        flags,seq, = struct.unpack('<BI', buffer(body[0:5]))
-        smeter,    = struct.unpack('>H',  buffer(body[5:7]))
-        data       = body[7:]
+        flags,seq, = _snd_header.unpack_from(body, 0)
+        smeter,    = _snd_smeter.unpack_from(body, _snd_header.size)
         rssi       = 0.1*smeter - 127
-        ##logging.info("SND flags %2d seq %6d RSSI %6.1f len %d" % (flags, seq, rssi, len(data)))
+        ##logging.info("SND flags %2d seq %6d RSSI %6.1f len %d" % (flags, seq, rssi, len(body)-_SND_DATA_OFFSET))
         if self._modulation == 'iq':
-            gps = dict(zip(['last_gps_solution', 'dummy', 'gpssec', 'gpsnsec'], struct.unpack('<BBII', buffer(data[0:10]))))
-            data = data[10:]
+            gps = dict(zip(['last_gps_solution', 'dummy', 'gpssec', 'gpsnsec'], _snd_iq_gps.unpack_from(body, _SND_DATA_OFFSET)))
             if self._options.raw is True:
-                self._process_iq_samples_raw_raw(seq, data)
+                ## the big-endian int16 I/Q payload is passed on as is
+                self._process_iq_samples_raw(seq, body[_IQ_DATA_OFFSET:], rssi, gps)
             else:
-                count = len(data) // 2
-                samples = np.ndarray(count, dtype='>h', buffer=data).astype(np.float32)
-                cs      = np.ndarray(count//2, dtype=np.complex64)
-                cs.real = samples[0:count:2]
-                cs.imag = samples[1:count:2]
+                ## view the payload as big-endian int16 I/Q pairs and convert
+                ## them to complex64 in a single pass
+                count = (len(body) - _IQ_DATA_OFFSET) // 4
+                iq = np.frombuffer(body, dtype='>i2', count=2*count, offset=_IQ_DATA_OFFSET)
+                cs = iq.astype(np.float32).view(np.complex64)
                 self._process_iq_samples(seq, cs, rssi, gps)
         else:
+            data = body[_SND_DATA_OFFSET:]
             if self._options.raw is True:
                 if self._compression:
                     data = self._decoder.decode(data)
@@ -319,13 +543,15 @@ class KiwiSDRStream(KiwiSDRStreamBase):
                 if self._compression:
                     samples = self._decoder.decode(data)
                 else:
-                    count = len(data) // 2
-                    samples = np.ndarray(count, dtype='>h', buffer=data).astype(np.int16)
+                    samples = np.frombuffer(data, dtype='>i2', count=len(data) // 2).astype(np.int16)
                 self._process_audio_samples(seq, samples, rssi)
 
     def _process_wf(self, body):
-        x_bin_server,flags_x_zoom_server,seq, = struct.unpack('<III', buffer(body[0:12]))
-        data = body[12:]
+        x_bin_server,flags_x_zoom_server,seq, = _wf_header.unpack_from(body, 0)
+        self._wf_start = x_bin_server
+        self._wf_zoom  = flags_x_zoom_server & 0xffff
+        self._wf_flags = flags_x_zoom_server >> 16
+        data = body[_wf_header.size:]
         logging.info("W/F seq %d len %d" % (seq, len(data)))
         if self._options.raw is True:
             return self._process_waterfall_samples_raw(data, seq)
@@ -334,7 +560,7 @@ class KiwiSDRStream(KiwiSDRStreamBase):
             samples = self._decoder.decode(data)
             samples = samples[:len(samples)-10]   # remove decompression tail
         else:
-            samples = np.ndarray(len(data), dtype='B', buffer=data)
+            samples = np.frombuffer(data, dtype=np.uint8)
         self._process_waterfall_samples(seq, samples)
 
     def _on_gnss_position(self, position):
@@ -349,6 +575,9 @@ class KiwiSDRStream(KiwiSDRStreamBase):
     def _process_iq_samples(self, seq, samples, rssi, gps):
         pass
 
+    def _process_iq_samples_raw(self, seq, data, rssi, gps):
+        pass
+
     def _process_waterfall_samples(self, seq, samples):
         pass
 
@@ -396,6 +625,9 @@ class KiwiSDRStream(KiwiSDRStreamBase):
             msg = self._writer_message();
             self._stream.send_message(msg)
         
+        self._check_time_limit()
+
+    def _check_time_limit(self):
         tlimit = self._options.tlimit
         if tlimit != None and self._start_time != None and time.time() - self._start_time > tlimit:
             raise KiwiTimeLimitError('time limit reached')
@@ -10,6 +10,8 @@ import cmath
 import traceback
 from optparse import OptionParser
 
+import numpy as np
+
 import kiwiclient
 import png
 
@@ -38,12 +40,12 @@ def norm_clamp(x, xmin, xmax):
     return (clamp(x, xmin, xmax) - xmin) / (xmax - xmin)
 
 def fm_detect(X, prev, shift):
-    vals = array.array('f')
-    for x in X:
-        y = shift + cmath.phase(x * prev.conjugate()) / math.pi
-        vals.append(y)
-        prev = x
-    return vals
+    X = np.asarray(X)
+    if not len(X):
+        return np.zeros(0, dtype=np.float32)
+    # X[n] * conj(X[n-1]), with prev as X[-1]
+    d = X * np.conj(np.concatenate(([prev], X[:-1])))
+    return (shift + np.angle(d) / math.pi).astype(np.float32)
 
 
 def dft_complex(input):
@@ -79,78 +81,69 @@ def idft_complex(input):
         w1 += w1d
     return output
 
-def bitreverse_sort(input):
-    output = list(input)
-
-    half_length = len(input) // 2
-    j = half_length
-    for i in xrange(1, len(input) - 1):
-        if i < j:
-            t = output[j]
-            output[j] = output[i]
-            output[i] = t
-        k = half_length
-        while k <= j:
-            j -= k
-            k = k >> 1
-        j += k
-
-    return output
-
-def log2(x):
-    return math.frexp(x)[1] - 1
-
-def fft_core(x):
-    length = len(x)
-
-    for l in xrange(1, log2(length) + 1):
-        le = 1 << l
-        le2 = le >> 1
-        w = 2 * math.pi / le
-        s = cmath.exp(complex(0, -w))
-        u = complex(1, 0)
-        for j in xrange(1, le2 + 1):
-            for i in xrange(j - 1, length, le):
-                o = i + le2
-                t = x[o] * u
-                x[o] = x[i] - t
-                x[i] = x[i] + t
-            u *= s
-
 def fft_complex(input):
-    x = bitreverse_sort(input)
-    fft_core(x)
-    return x
+    return list(np.fft.fft(np.asarray(input, dtype=np.complex128)))
 
 def ifft_complex(input):
     "Computes an inverse FFT transform for complex-valued input"
-    x = bitreverse_sort(input)
-    x = [ v.conjugate() for v in x ]
-    fft_core(x)
-    n_inv = 1.0 / len(x)
-    x = [ v.conjugate() * n_inv for v in x ]
-    return x
+    return list(np.fft.ifft(np.asarray(input, dtype=np.complex128)))
 
 def power_db(input):
-    nf = 1.0 / len(input)
-    return [ 10 * math.log10(abs(x) * nf) for x in input ]
-
-def peak_detect(data, thresh):
-    data = array.array('f', data)
-    peak_radius = 50
+    return 10 * np.log10(np.abs(input) * (1.0 / len(input)))
+
+
+class PowerSpectrum:
+    """Power spectra (dB, DC in the middle) of overlapping windows of complex samples
+
+    Samples are collected in a reusable buffer of `size` samples; each time it
+    is full, the spectrum is computed with numpy.fft and the buffer is
+    advanced by `shift` samples, keeping the overlapping part.
+    """
+    def __init__(self, size, shift, window=None, dc_removal=False):
+        self._size = size
+        self._shift = shift
+        self._window = None if window is None else np.asarray(window, dtype=np.float64)
+        self._dc_removal = dc_removal
+        self._buffer = np.zeros(size, dtype=np.complex128)
+        self._fill = 0
+    def process(self, samples):
+        "Returns the list of spectra completed by the samples"
+        samples = np.asarray(samples)
+        spectra = []
+        while len(samples):
+            n = min(len(samples), self._size - self._fill)
+            self._buffer[self._fill:self._fill + n] = samples[:n]
+            self._fill += n
+            samples = samples[n:]
+            if self._fill == self._size:
+                spectra.append(self._spectrum())
+                self._buffer[:self._size - self._shift] = self._buffer[self._shift:]
+                self._fill -= self._shift
+        return spectra
+    def _spectrum(self):
+        X = self._buffer if self._window is None else self._buffer * self._window
+        P = power_db(np.fft.fft(X))
+        # DC "removal" for IQ
+        if self._dc_removal:
+            P[0] = P[1]
+        # Panoramize
+        return np.fft.fftshift(P)
+
+def peak_detect(data, thresh, peak_radius=50):
+    """Returns [(bin, power)] of the peaks >= thresh, strongest first; bins
+    within peak_radius of a stronger peak are suppressed"""
+    # NOTE: values are rounded to float32 as they always were
+    data = np.asarray(data, dtype=np.float32).astype(np.float64)
+    candidates = np.flatnonzero(data >= thresh)
+    # Strongest first; on ties the lower bin wins
+    candidates = candidates[np.argsort(-data[candidates], kind='stable')]
+    suppressed = np.zeros(len(data), dtype=bool)
     peaks = []
-    while True:
-        peak_index = 0
-        peak_value = data[peak_index]
-        for i in xrange(1, len(data)):
-            if peak_value < data[i]:
-                peak_value = data[i]
-                peak_index = i
-        if peak_value < thresh:
-            break
-        peaks.append((peak_index, peak_value))
-        for i in xrange(max(peak_index - peak_radius, 0), min(peak_index + peak_radius + 1, len(data))):
-            data[i] = -999
+    for i in candidates:
+        if suppressed[i]:
+            continue
+        peaks.append((int(i), float(data[i])))
+        suppressed[max(i - peak_radius, 0):i + peak_radius + 1] = True
     return peaks
 
 
@@ -158,26 +151,28 @@ class FMDetectorAtan2:
     def __init__(self):
         self._prev = complex(0)
     def process(self, samples):
-        Y = array.array('f')
-        prev = self._prev
-        for x in samples:
-            y = cmath.phase(x * prev.conjugate()) / math.pi
-            Y.append(y)
-            prev = x
-        self._prev = prev
+        samples = np.asarray(samples)
+        Y = fm_detect(samples, self._prev, 0)
+        if len(samples):
+            self._prev = samples[-1]
         return Y
 
 class IQConverterDDC:
     """Convert audio samples to IQ: digital down-convert method"""
     def __init__(self, fc):
         "fc is the LO frequency divided by the sample rate"
-        self._w = cmath.rect(1, -fc * 2 * math.pi)
+        self._fc = fc
         self._v = complex(1)
+        self._osc = np.zeros(0, dtype=np.complex128)
     def process(self, samples):
-        Y = []
-        for x in samples:
-            Y.append(x * self._v)
-            self._v *= self._w
+        samples = np.asarray(samples)
+        n = len(samples)
+        # Precomputed oscillator exp(-j*2*pi*fc*k), k = 0..n-1, started at the current phase
+        if len(self._osc) < n:
+            self._osc = np.exp(-2j * math.pi * self._fc * np.arange(n))
+        Y = samples * (self._v * self._osc[:n])
+        self._v *= cmath.rect(1, -2 * math.pi * self._fc * n)
+        self._v /= abs(self._v)
         return Y
 
 class IQConverterFFT:
@@ -202,48 +197,68 @@ def interp_hermite(t, p0, p1, p2, p3):
     return c0 + (t * (c1 + (t * (c2 + (t * c3)))))
 
 class Interpolator:
+    """Hermite interpolation resampler working on blocks
+
+    All output positions of a block are computed at once; the fractional
+    position and the input samples still needed (at most 3 plus the ones
+    not reached yet) are carried over to the next block.
+    """
     def __init__(self, factor):
-        self._buffer = array.array('f')
+        self._buffer = np.zeros(0)
         self._t = 0
         self.set_factor(factor)
     def set_factor(self, factor):
         self._dt = factor
-    def extend(self, samples):
-        for x in samples:
-            self._buffer.append(float(x))
-    def __iter__(self):
-        return self
-    def next(self):
-        t_int = math.trunc(self._t)
-        t_frac = self._t - t_int
-        if t_int + 3 >= len(self._buffer):
-            self._flush()
-            raise StopIteration()
-        self._t += self._dt
-        return interp_hermite(t_frac, self._buffer[t_int], self._buffer[t_int + 1], self._buffer[t_int + 2], self._buffer[t_int + 3])
-    def _flush(self):
-        t_int = math.trunc(self._t)
-        t_new = min(t_int, len(self._buffer))
+    def process(self, samples):
+        "Returns the interpolated samples (float32) available after adding samples"
+        buf = np.concatenate((self._buffer, np.asarray(samples, dtype=np.float64)))
+        last = len(buf) - 3
+        # Output positions t, t+dt, ... as sums of dt, then cut at the last one with 4 samples
+        count = max(0, int(math.ceil((last - self._t) / self._dt)) + 2)
+        t = np.cumsum(np.concatenate(([self._t], np.full(count, self._dt))))
+        n = int(np.searchsorted(t, last, side='left'))
+        t_int = t[:n].astype(np.intp)
+        t_frac = t[:n] - t_int
+        Y = interp_hermite(t_frac, buf[t_int], buf[t_int + 1], buf[t_int + 2], buf[t_int + 3])
+        # Drop the samples before the next position
+        self._t = t[n]
+        t_new = min(math.trunc(self._t), len(buf))
         if t_new > 0:
             self._t -= t_new
-            self._buffer = self._buffer[t_new:]
+            buf = buf[t_new:]
+        self._buffer = buf
+        return Y.astype(np.float32)
 
 class FIRFilter:
+    """Streaming FIR filter for real or complex samples
+
+    Only the last len(kernel)-1 input samples are kept between blocks; each
+    block is convolved at once, directly or via FFT for long kernels.
+    """
+    FFT_MIN_TAPS = 64
     def __init__(self, kernel):
-        self._kernel = kernel
-        self._buffer = []
+        self._kernel = np.asarray(kernel, dtype=np.float64)
+        self._history = np.zeros(0)
+        self._kernel_fft = {}
     def process(self, samples):
-        self._buffer.extend(samples)
-        Y = []
-        i = 0
-        while i + len(self._kernel) < len(self._buffer):
-            y = 0
-            for j in xrange(len(self._kernel)):
-                y += self._buffer[i+j] * self._kernel[-j-1]
-            Y.append(y)
-            i += 1
-        self._buffer = self._buffer[i:]
-        return Y
+        x = np.concatenate((self._history, np.asarray(samples)))
+        taps = len(self._kernel)
+        if len(x) < taps:
+            self._history = x
+            return x[:0]
+        if taps < self.FFT_MIN_TAPS:
+            y = np.convolve(x, self._kernel, 'valid')
+        else:
+            y = self._convolve_fft(x)
+        self._history = x[len(x) - taps + 1:]
+        return y
+    def _convolve_fft(self, x):
+        taps = len(self._kernel)
+        nfft = 1 << (len(x) + taps - 2).bit_length()
+        if nfft not in self._kernel_fft:
+            self._kernel_fft[nfft] = np.fft.fft(self._kernel, nfft)
+        y = np.fft.ifft(np.fft.fft(x, nfft) * self._kernel_fft[nfft])[taps - 1:len(x)]
+        return y if np.iscomplexobj(x) else y.real
 
 def generate_sinc(fc, length):
     "Generates a sinc kernel"
@@ -321,14 +336,17 @@ class KiwiFax(kiwiclient.KiwiSDRStream):
         self._iqfir = None
         self._tuning_offset = options.force_offset
         self._ss_window_size = 4096
-        self._startstop_buffer = []
+        # Overlapping FFTs increase the temporal resolution
+        self._startstop_spectrum = PowerSpectrum(self._ss_window_size, self._ss_window_size // 2,
+                                                 dc_removal=self._use_iq)
         self._startstop_score = 0
 
         self._prevX = complex(0)
         self._phasing_count = 0
         self._resampler = None
         self._line_scale_factor = 1.0 - 1e-6 * options.sr_coeff
-        self._rows = []
+        self._rows = bytearray()
+        self._image = None
         self._pixel_buffer = array.array('f')
         # TODO: compute instead of hardcoding
         self._pixels_per_line = 1809
@@ -346,6 +364,7 @@ class KiwiFax(kiwiclient.KiwiSDRStream):
         logging.info("Switching to: %s", new_state)
         self._state = new_state
         if new_state == 'idle':
+            self._close_image()
             self._startstop_score = 0
             self._noise_score = 0
             self._histoa.clear()
@@ -410,13 +429,13 @@ class KiwiFax(kiwiclient.KiwiSDRStream):
 
     def _process_audio_samples(self, seq, samples, rssi):
         k = 1 / 32768.0
-        samples = [ x * k for x in samples ]
+        samples = np.asarray(samples) * k
         samples = self._iqconverter.process(samples)
         self._process_samples(seq, samples, rssi)
 
     def _process_iq_samples(self, seq, samples, rssi, gps):
         k = 1 / 32768.0
-        samples = [ x * k for x in samples ]
+        samples = np.asarray(samples) * k
         self._process_samples(seq, samples, rssi)
 
     def _process_samples(self, seq, samples, rssi):
@@ -436,36 +455,18 @@ class KiwiFax(kiwiclient.KiwiSDRStream):
                 self._startstop_score = 0
 
     def _process_startstop(self, samples):
-        self._startstop_buffer.extend(samples)
-        # Snip out a window for start/stop processing
-        # Window size defines the overall size of the window
-        # Window shift defines how many samples are discarded after each iteration
-        # This allows for overlapping FFTs thus increasing temporal resolution
-        window_shift = self._ss_window_size / 2
-        while len(self._startstop_buffer) >= self._ss_window_size:
-            window = self._startstop_buffer[:self._ss_window_size]
-            self._startstop_buffer = self._startstop_buffer[window_shift:]
-            self._process_startstop_piece(window)
-
-    def _process_startstop_piece(self, samples):
-        # Compute the power spectrum
-        samples = fft_complex(samples)
-        P = power_db(samples)
-        # DC "removal" for IQ
-        if self._use_iq:
-            P[0] = P[1]
-        # Panoramize
-        P1 = P[len(P)//2:]
-        P1.extend(P[:len(P)//2])
-        P = P1
+        for P in self._startstop_spectrum.process(samples):
+            self._process_startstop_piece(P)
+
+    def _process_startstop_piece(self, P):
+        "P is the power spectrum of one start/stop window"
         # DUMP POINT
         if self._options.dump_spectra and self._state != 'idle':
             dump_to_csv(self._output_name + '-ss.csv', P)
         # Assume noise floor is the median value + 5dB
         Px = P[2048-425:2048+425]
-        Psorted = sorted(Px)
-        nf_level = Psorted[len(Psorted) // 2] + 5.0
-        pk_level = Psorted[-1]
+        nf_level = np.partition(Px, len(Px) // 2)[len(Px) // 2] + 5.0
+        pk_level = np.max(Px)
         peaks = peak_detect(P, nf_level + 10)
         logging.info("Peaks: [%s]", ' '.join([ '%04d:%+05.1f' % (x[0], x[1]) for x in peaks ]))
         # For each peak, test if it's the one around the start/stop middle freq
@@ -523,7 +524,8 @@ class KiwiFax(kiwiclient.KiwiSDRStream):
                 self._switch_state('idle')
 
     def _new_roll(self):
-        self._rows = []
+        self._close_image()
+        self._rows = bytearray()
         ts = time.strftime('%Y%m%dT%H%MZ', time.gmtime())
         self._output_name = '%s_%d' % (ts, int(self._options.frequency * 1000))
         if self._options.station:
@@ -545,8 +547,7 @@ class KiwiFax(kiwiclient.KiwiSDRStream):
         for x in pixels:
             self._histob.put(x)
         # Scale and adjust pixel rate
-        self._resampler.extend(pixels)
-        self._pixel_buffer.extend(self._resampler)
+        self._pixel_buffer.extend(self._resampler.process(pixels))
 
         if self._state == 'phasing':
             self._process_phasing()
@@ -585,33 +586,49 @@ class KiwiFax(kiwiclient.KiwiSDRStream):
         else:
             self._pixel_buffer = self._pixel_buffer[max(0, i - phasing_pulse_size):]
 
+    def _num_rows(self):
+        return len(self._rows) // self._pixels_per_line
+
     def _process_row(self, row):
-        pixels = array.array('B')
-        for x in row:
-            pixels.append(int(clamp(x, 0, 1) * 255))
-        self._rows.append(pixels)
-        if len(self._rows) % 16:
+        pixels = (np.clip(np.asarray(row, dtype=np.float64), 0, 1) * 255).astype(np.uint8)
+        self._rows += pixels.tobytes()
+        if self._image is None:
+            self._image = png.StreamWriter(self._output_name + '.png', len(pixels),
+                                           greyscale=True, filter_type='adaptive')
+        self._image.write_rows(pixels)
+        if self._num_rows() % 16:
             return
         self._flush_rows()
-        if len(self._rows) >= self._max_height:
+        if self._num_rows() >= self._max_height:
             logging.info("Length exceeded; cutting the paper")
             self._switch_state('idle')
 
     def _flush_rows(self):
-        if not self._rows:
+        if self._image is None:
             return
+        # Only the rows since the last flush are written; the file is a
+        # complete PNG afterwards, so it doubles as a preview
         while True:
-            with open(self._output_name + '.png', 'wb') as fp:
-                try:
-                    png.Writer(len(self._rows[0]), len(self._rows), greyscale=True).write(fp, self._rows)
-                    break
-                except KeyboardInterrupt:
-                    pass
+            try:
+                self._image.commit()
+                break
+            except KeyboardInterrupt:
+                pass
         # DUMP POINT
         if self._options.dump_histo:
             dump_to_csv(self._output_name + '-hh.csv', self._histoa.get(), 'w')
             dump_to_csv(self._output_name + '-hh.csv', self._histob.get(), 'a')
 
+    def _close_image(self):
+        if self._image is None:
+            return
+        self._image.close()
+        self._image = None
+
+    def close(self):
+        self._close_image()
+        super(KiwiFax, self).close()
+
 
 KNOWN_CORRECTION_FACTORS = {
     'kiwisdr.northlandradio.nz:8073': {
@@ -1,14 +1,16 @@
 #!/usr/bin/env python
 ## -*- python -*-
 
-import array, logging, os, struct, sys, time, copy, threading, os
+import array, json, logging, os, signal, struct, sys, time, copy, threading, os
 import gc
 import math
 import numpy as np
+from fractions import Fraction
 from copy import copy
+from collections import deque
 from traceback import print_exc
-from kiwiclient import KiwiSDRStream
-from kiwiworker import KiwiWorker
+from kiwiclient import KiwiSDRStream, Squelch, waterfall_stats
+from kiwiwf import KiwiWfArchiveWriter
 from optparse import OptionParser
 
 HAS_RESAMPLER = True
@@ -16,7 +18,7 @@ try:
     ## if available use libsamplerate for resampling
     from samplerate import Resampler
 except ImportError:
-    ## otherwise linear interpolation is used
+    ## otherwise PolyphaseResampler is used
     HAS_RESAMPLER = False
 
 
@@ -29,58 +31,313 @@ def _write_wav_header(fp, filesize, samplerate, num_channels, is_kiwi_wav):
     if not is_kiwi_wav:
         fp.write(struct.pack('<4sI', b'data', filesize - 12 - 8 - 16 - 8))
 
-class RingBuffer(object):
-    def __init__(self, len):
-        self._array = np.zeros(len, dtype='float')
-        self._index = 0
-        self._is_filled = False
+class KiwiWavWriter(object):
+    """Long-lived WAV file sink.
 
-    def insert(self, sample):
-        self._array[self._index] = sample;
-        self._index += 1
-        if self._index == len(self._array):
-            self._is_filled = True;
-            self._index = 0
+    The file stays open and sample data goes through a buffered file object.
+    The RIFF (and, for standard WAV files, data) chunk sizes in the header are
+    tracked in memory and patched in place only every header_interval seconds,
+    when the file is rotated, and on close.
 
-    def is_filled(self):
-        return self._is_filled
+    Flush policy: the buffered data is flushed together with each header
+    update. After a crash the file is therefore a valid WAV file covering all
+    data up to the last header update, i.e. at most header_interval seconds
+    (plus the OS write-back delay) are lost. header_interval=0 updates the
+    header after every block.
+    """
 
-    def median(self):
-        return np.median(self._array)
+    def __init__(self, filename, samplerate, num_channels, is_kiwi_wav, header_interval=1.0, buffer_size=64*1024):
+        self._samplerate   = samplerate
+        self._num_channels = num_channels
+        self._is_kiwi_wav  = is_kiwi_wav
+        self._header_interval = header_interval
+        self._fp = open(filename, 'wb', buffer_size)
+        _write_wav_header(self._fp, 100, self._samplerate, self._num_channels, self._is_kiwi_wav)
+        self._filesize = self._fp.tell()
+        self._last_header_update = time.time()
 
+    def write(self, samples, gps=None):
+        sample_size = samples.nbytes
+        if self._is_kiwi_wav:
+            self._fp.write(struct.pack('<4sIBBII', b'kiwi', 10, gps['last_gps_solution'], 0, gps['gpssec'], gps['gpsnsec']))
+            self._fp.write(struct.pack('<4sI', b'data', sample_size))
+            self._filesize += 18 + 8
+        self._fp.write(samples)
+        self._filesize += sample_size
+        if time.time() - self._last_header_update >= self._header_interval:
+            self.update_header()
+
+    def update_header(self):
+        self._fp.seek(0, os.SEEK_SET)
+        _write_wav_header(self._fp, self._filesize, self._samplerate, self._num_channels, self._is_kiwi_wav)
+        self._fp.seek(0, os.SEEK_END)
+        self._fp.flush()
+        self._last_header_update = time.time()
+
+    def close(self):
+        if self._fp is None:
+            return
+        self.update_header()
+        self._fp.close()
+        self._fp = None
+
+
+class KiwiWriterQueue(object):
+    """Bounded queue of file operations drained by a dedicated writer thread.
+
+    Decouples disk I/O from the websocket receive thread: a slow write or an
+    SD-card stall fills the queue instead of backing up the TCP socket.
+    Operations are executed in order. When the queue is full, droppable
+    operations (sample blocks) are handled according to the overflow policy:
+      block       wait until there is room (no data loss)
+      drop-oldest discard the oldest queued droppable operation
+      warn        discard the new operation, count it and warn
+    Non-droppable operations (e.g. closing a file) are never discarded.
+    The writer thread is started on demand and stopped by close().
+    """
+
+    def __init__(self, maxsize, overflow='block', name='writer'):
+        self._maxsize  = maxsize
+        self._overflow = overflow
+        self._name     = name
+        self._items    = deque()
+        self._cond     = threading.Condition()
+        self._thread   = None
+        self._closing  = False
+        self._max_depth   = 0
+        self._num_dropped = 0
+        self._num_written = 0
+        self._latency_sum = 0.0
+        self._latency_max = 0.0
+        self._last_warning = 0
+
+    def _start(self):
+        self._closing = False
+        self._thread  = threading.Thread(target=self._run, name=self._name)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def put(self, fn, args=(), droppable=False):
+        with self._cond:
+            if self._thread is None:
+                self._start()
+            if len(self._items) >= self._maxsize:
+                if not droppable or self._overflow == 'block':
+                    while len(self._items) >= self._maxsize:
+                        self._cond.wait()
+                elif self._overflow == 'drop-oldest' and self._drop_oldest():
+                    pass
+                else:
+                    self._num_dropped += 1
+                    self._warn_dropped()
+                    return
+            self._items.append((fn, args, droppable))
+            self._max_depth = max(self._max_depth, len(self._items))
+            self._cond.notify_all()
+
+    def _drop_oldest(self):
+        for i,item in enumerate(self._items):
+            if item[2]:
+                del self._items[i]
+                self._num_dropped += 1
+                self._warn_dropped()
+                return True
+        return False
+
+    def _warn_dropped(self):
+        now = time.time()
+        if now - self._last_warning >= 10:
+            self._last_warning = now
+            logging.warn('%s: queue full, %d blocks dropped so far' % (self._name, self._num_dropped))
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._items and not self._closing:
+                    self._cond.wait()
+                if not self._items:
+                    return
+                fn, args, droppable = self._items[0]
+            t0 = time.time()
+            try:
+                fn(*args)
+            except Exception:
+                print_exc()
+            dt = time.time() - t0
+            with self._cond:
+                self._items.popleft()
+                self._num_written += 1
+                self._latency_sum += dt
+                self._latency_max  = max(self._latency_max, dt)
+                self._cond.notify_all()
+
+    def close(self):
+        """Execute all queued operations and stop the writer thread"""
+        with self._cond:
+            if self._thread is None:
+                return
+            self._closing = True
+            self._cond.notify_all()
+        self._thread.join()
+        self._thread = None
+
+    def metrics(self):
+        with self._cond:
+            return {'queue_depth': len(self._items),
+                    'queue_max_depth': self._max_depth,
+                    'dropped': self._num_dropped,
+                    'write_latency_avg_ms': round(1e3*self._latency_sum/max(1, self._num_written), 3),
+                    'write_latency_max_ms': round(1e3*self._latency_max, 3)}
+
+
+def _float_to_int16(samples):
+    """Round float samples in place and convert them to int16 with saturation"""
+    np.rint(samples, out=samples)
+    np.maximum(samples, -32768, out=samples)
+    np.minimum(samples,  32767, out=samples)
+    return samples.astype(np.int16)
+
+
+class PolyphaseResampler(object):
+    """Streaming resampler for an arbitrary ratio, used when libsamplerate is
+    not available.
+
+    The filter is a Kaiser-windowed sinc whose polyphase components are
+    approximated by polynomials in the fractional delay (Farrow structure).
+    When the ratio of the rates is a fraction M/L with a small L (e.g.
+    12000 -> 8000 Hz), the output phases repeat every L output samples: the
+    L polyphase filters are then evaluated once and each block is resampled
+    by a single matrix product of the input, viewed as overlapping rows of
+    M samples, with the filter bank. The taps are computed once per (input
+    rate, output rate). Other ratios (e.g. a measured sample rate of
+    12001.135 Hz) would need the filter at arbitrary positions, which is
+    slower in numpy than linear interpolation: the samples are then
+    interpolated linearly, as before. Filter state (the last input samples)
+    and the phase of the next output sample are carried over from block to
+    block, so there are no discontinuities at block boundaries. The work
+    arrays are kept from block to block. Works for real and complex (IQ)
+    input.
+    """
+    _taps_cache = {} ## (input rate, output rate, order) -> Farrow taps, shape (order+1, number of taps)
+    MAX_PHASES  = 256
+
+    def __init__(self, input_rate, output_rate, order=3):
+        self._step = float(input_rate)/output_rate ## input samples per output sample
+        ## exact ratio of the rates, if it is a fraction with a small denominator
+        ratio = Fraction(input_rate) / Fraction(output_rate)
+        self._period = None
+        if ratio.denominator <= self.MAX_PHASES:
+            self._taps = self._get_taps(input_rate, output_rate, order)
+            self._num_taps = self._taps.shape[1]
+            ## rows of several periods when L is small: a matrix product with
+            ## only one or two columns is dominated by its fixed cost
+            g = int(math.ceil(16.0/ratio.denominator))
+            self._period = (g*ratio.numerator, g*ratio.denominator)
+        ## sample types of the work arrays, for real and complex input
+        self._dtypes = (np.float32, np.complex64)
+        if self._period is None:
+            ## linear interpolation between two input samples, in float64
+            ## which np.interp uses anyway
+            self._num_taps = 2
+            self._dtypes = (np.float64, np.complex128)
+        ## the first output sample is aligned with the first input sample
+        self._num_history = self._num_taps//2 - 1
+        self._buf   = np.zeros(self._num_history, dtype=self._dtypes[0])
+        self._size  = 0
+        self._pos   = 0.0 ## position of the next output sample
+        self._phase = 0   ## index of the next output sample in its period
+
+    @classmethod
+    def _get_taps(cls, input_rate, output_rate, order):
+        key = (input_rate, output_rate, order)
+        if key not in cls._taps_cache:
+            cutoff   = 0.9*min(1.0, float(output_rate)/input_rate)
+            num_taps = 2*int(math.ceil(8/cutoff))
+            half     = num_taps//2
+            ## h[k,j]: tap j of the filter for the fractional delay f[k]
+            f = np.linspace(0, 1, 8*(order+1))
+            x = (np.arange(num_taps) - (half-1))[np.newaxis,:] - f[:,np.newaxis]
+            h = np.sinc(cutoff*x) * np.i0(8.0*np.sqrt(np.maximum(0, 1 - (x/half)**2)))
+            h /= np.sum(h, axis=1)[:,np.newaxis]
+            ## least-squares fit of h[:,j] by a polynomial in f, highest power first
+            c = np.polyfit(f, h, order)
+            cls._taps_cache[key] = c.astype(np.float32)
+        return cls._taps_cache[key]
+
+    def _make_bank(self, dtype):
+        """Filter bank for one period: column r holds the filter of output
+        sample r, placed at its integer offset in a row of M+taps samples;
+        complex samples are filtered as interleaved float32 (I,Q) pairs"""
+        M, L = self._period
+        T    = self._num_taps
+        bank = np.zeros((M+T, L), dtype=np.float32)
+        for r in range(L):
+            i, f = divmod(r*M, L)
+            bank[i:i+T, r] = np.polyval(self._taps.astype(np.float64), float(f)/L)
+        if dtype == np.complex64:
+            bank = np.kron(bank, np.eye(2, dtype=np.float32))
+        return bank
+
+    def _alloc(self, dtype, size):
+        self._size = size
+        ## the last row used with the filter bank may extend beyond the input
+        if self._period is not None:
+            size += 2*self._period[0] + self._num_taps
+        buf = np.zeros(size, dtype=dtype)
+        buf[:self._num_history] = self._buf[:self._num_history]
+        self._buf = buf
+        T = self._num_taps
+        c = buf.itemsize//4
+        if self._period is not None:
+            M = self._period[0]
+            self._bank = self._make_bank(dtype)
+            self._rows = np.ndarray(((size-T)//M, c*(M+T)), np.float32, buf, 0, (M*buf.itemsize, 4))
+        else:
+            self._xp   = np.arange(size, dtype=np.float64)
+            self._ramp = self._step*np.arange(int(size/self._step) + 2)
+
+    def process(self, samples):
+        """Resample one block of int16/float32 (or complex64) samples,
+        returns a float (or complex) array"""
+        dtype = self._dtypes[samples.dtype.kind == 'c']
+        nbuf  = self._num_history + len(samples)
+        if nbuf > self._size or dtype != self._buf.dtype:
+            self._alloc(dtype, max(2*nbuf, 4*self._num_taps))
+        buf = self._buf
+        buf[self._num_history:nbuf] = samples
+        n = nbuf - self._num_taps + 1 ## number of filter positions
+        if self._period is not None:
+            ## output r of this block (counted from the start of the period
+            ## at buf[0]) needs the filter position floor(r*M/L) < n
+            M, L  = self._period
+            end   = -(-max(n, 0)*L // M)
+            rows  = -(-end // L)
+            out   = np.dot(self._rows[:rows], self._bank).view(dtype).ravel()[self._phase:end]
+            start = min((end // L)*M, nbuf)
+            self._phase = end % L
+        else:
+            ## positions of the output samples in this block
+            m   = max(0, int(math.ceil((n - self._pos)/self._step)))
+            t   = self._ramp[:m] + self._pos
+            out = np.interp(t, self._xp[:nbuf], buf[:nbuf])
+            next_pos  = self._pos + self._step*m
+            start     = min(int(next_pos), nbuf)
+            self._pos = next_pos - start
+        ## keep the input needed by the next output sample
+        self._num_history = nbuf - start
+        buf[:self._num_history] = buf[start:nbuf]
+        return out
+
+    def process_int16(self, samples):
+        """Resample one block, returns int16 samples (interleaved I,Q for
+        complex input)"""
+        out = self.process(samples)
+        out = out.view(out.real.dtype)
+        if self._period is None:
+            ## linear interpolation does not leave the range of the input
+            return np.rint(out, out=out).astype(np.int16)
+        return _float_to_int16(out)
 
-class Squelch(object):
-    def __init__(self, options):
-        self._status_msg  = not options.quiet
-        self._threshold   = options.thresh
-        self._tail_delay  = round(options.squelch_tail*12000/512) ## seconds to number of buffers
-        self._ring_buffer = RingBuffer(65)
-        self._squelch_on_seq = None
-
-    def process(self, seq, rssi):
-        if not self._ring_buffer.is_filled() or self._squelch_on_seq is None:
-            self._ring_buffer.insert(rssi)
-        if not self._ring_buffer.is_filled():
-            return False
-        median_nf   = self._ring_buffer.median()
-        rssi_thresh = median_nf + self._threshold
-        is_open     = self._squelch_on_seq is not None
-        if is_open:
-            rssi_thresh -= 6
-        rssi_green = rssi >= rssi_thresh
-        if rssi_green:
-            self._squelch_on_seq = seq
-            is_open = True
-        if self._status_msg:
-            sys.stdout.write('\r Median: %6.1f Thr: %6.1f %s' % (median_nf, rssi_thresh, ("s", "S")[is_open]))
-            sys.stdout.flush()
-        if not is_open:
-            return False
-        if seq > self._squelch_on_seq + self._tail_delay:
-            logging.info("\nSquelch closed")
-            self._squelch_on_seq = None
-            return False
-        return is_open
 
 class KiwiSoundRecorder(KiwiSDRStream):
     def __init__(self, options):
@@ -92,10 +349,24 @@ class KiwiSoundRecorder(KiwiSDRStream):
         self._freq = freq
         self._start_ts = None
         self._start_time = None
-        self._squelch = Squelch(self._options) if options.thresh is not None else None
+        self._squelch = Squelch(self._options, status_msg=not options.quiet) if options.thresh is not None else None
         self._num_channels = 2 if options.modulation == 'iq' else 1
         self._last_gps = dict(zip(['last_gps_solution', 'dummy', 'gpssec', 'gpsnsec'], [0,0,0,0]))
         self._resampler = None
+        self._wav_writer = None
+        self._file_open = False ## samples were written since the last _close_file()
+        self._writer_queue = None
+        if options.writer_queue > 0:
+            self._writer_queue = KiwiWriterQueue(options.writer_queue, options.writer_overflow,
+                                                 'writer %d' % options.idx)
+        self._num_blocks = 0
+        self._num_bytes = 0
+
+    def stats(self):
+        stats = {'blocks': self._num_blocks, 'bytes': self._num_bytes}
+        if self._writer_queue is not None:
+            stats.update(self._writer_queue.metrics())
+        return stats
 
     def _setup_rx_params(self):
         self.set_name(self._options.user)
@@ -119,8 +390,9 @@ class KiwiSoundRecorder(KiwiSDRStream):
             self._ratio = float(self._output_sample_rate)/self._sample_rate
             logging.info('resampling from %g to %d Hz (ratio=%f)' % (self._sample_rate, self._options.resample, self._ratio))
             if not HAS_RESAMPLER:
-                logging.info("libsamplerate not available: linear interpolation is used for low-quality resampling. "
+                logging.info("libsamplerate not available: using the built-in polyphase resampler. "
                              "(pip install samplerate)")
+        self._resampler = None
 
     def _process_audio_samples(self, seq, samples, rssi):
         if self._options.quiet is False:
@@ -129,8 +401,7 @@ class KiwiSoundRecorder(KiwiSDRStream):
         if self._squelch:
             is_open = self._squelch.process(seq, rssi)
             if not is_open:
-                self._start_ts = None
-                self._start_time = None
+                self._close_file()
                 return
 
         if self._options.resample > 0:
@@ -140,11 +411,10 @@ class KiwiSoundRecorder(KiwiSDRStream):
                     self._resampler = Resampler(converter_type='sinc_best')
                 samples = np.round(self._resampler.process(samples, ratio=self._ratio)).astype(np.int16)
             else:
-                ## resampling by linear interpolation
-                n  = len(samples)
-                xa = np.arange(round(n*self._ratio))/self._ratio
-                xp = np.arange(n)
-                samples = np.round(np.interp(xa,xp,samples)).astype(np.int16)
+                ## streaming polyphase resampling
+                if self._resampler is None:
+                    self._resampler = PolyphaseResampler(self._sample_rate, self._output_sample_rate)
+                samples = self._resampler.process_int16(samples)
 
         self._write_samples(samples, {})
 
@@ -152,31 +422,26 @@ class KiwiSoundRecorder(KiwiSDRStream):
         if self._squelch:
             is_open = self._squelch.process(seq, rssi)
             if not is_open:
-                self._start_ts = None
-                self._start_time = None
+                self._close_file()
                 return
         ##print gps['gpsnsec']-self._last_gps['gpsnsec']
         self._last_gps = gps
-        ## convert list of complex numbers into an array
-        s = np.zeros(2*len(samples), dtype=np.int16)
-        s[0::2] = np.real(samples).astype(np.int16)
-        s[1::2] = np.imag(samples).astype(np.int16)
-        if self._options.resample > 0:
-            if HAS_RESAMPLER:
+        if self._options.resample > 0 and not HAS_RESAMPLER:
+            ## streaming polyphase resampling, the output is interleaved I/Q
+            if self._resampler is None:
+                self._resampler = PolyphaseResampler(self._sample_rate, self._output_sample_rate)
+            s = self._resampler.process_int16(samples)
+        else:
+            ## convert list of complex numbers into an array
+            s = np.zeros(2*len(samples), dtype=np.int16)
+            s[0::2] = np.real(samples).astype(np.int16)
+            s[1::2] = np.imag(samples).astype(np.int16)
+            if self._options.resample > 0:
                 ## libsamplerate resampling
                 if self._resampler is None:
                     self._resampler = Resampler(channels=2, converter_type='sinc_best')
                 s = self._resampler.process(s.reshape(len(samples),2), ratio=self._ratio)
                 s = np.round(s.reshape(1, np.size(s))).astype(np.int16)
-            else:
-                ## resampling by linear interpolation
-                n  = len(samples)
-                m  = int(round(n*self._ratio))
-                xa = np.arange(m)/self._ratio
-                xp = np.arange(n)
-                s  = np.zeros(2*m, dtype=np.int16)
-                s[0::2] = np.round(np.interp(xa,xp,np.real(samples))).astype(np.int16)
-                s[1::2] = np.round(np.interp(xa,xp,np.imag(samples))).astype(np.int16)
 
         self._write_samples(s, gps)
 
@@ -202,43 +467,61 @@ class KiwiSoundRecorder(KiwiSDRStream):
             filename = '%s/%s' % (self._options.dir, filename)
         return filename
 
-    def _update_wav_header(self):
-        with open(self._get_output_filename(), 'r+b') as fp:
-            fp.seek(0, os.SEEK_END)
-            filesize = fp.tell()
-            fp.seek(0, os.SEEK_SET)
+    def _close_file(self):
+        ## while squelched this is called for every block: queue a close only
+        ## when there is a file to close
+        if not self._file_open:
+            return
+        self._file_open = False
+        if self._writer_queue is not None:
+            self._writer_queue.put(self._close_wav_writer)
+        else:
+            self._close_wav_writer()
 
-            # fp.tell() sometimes returns zero. _write_wav_header writes filesize - 8
-            if filesize >= 8:
-                _write_wav_header(fp, filesize, int(self._output_sample_rate), self._num_channels, self._options.is_kiwi_wav)
+    def _close_wav_writer(self):
+        if self._wav_writer is not None:
+            self._wav_writer.close()
+            self._wav_writer = None
+        self._start_ts = None
+        self._start_time = None
 
     def _write_samples(self, samples, *args):
-        """Output to a file on the disk."""
+        """Output to a file on the disk, in the writer thread if there is one."""
         now = time.gmtime()
+        self._file_open = True
+        if self._writer_queue is not None:
+            self._writer_queue.put(self._store_samples, (now, samples, args[0]), droppable=True)
+        else:
+            self._store_samples(now, samples, args[0])
+
+    def _store_samples(self, now, samples, gps):
         sec_of_day = lambda x: 3600*x.tm_hour + 60*x.tm_min + x.tm_sec
         if self._start_ts is None or (self._options.filename == '' and
                                       self._options.dt != 0 and
                                       sec_of_day(now)//self._options.dt != sec_of_day(self._start_ts)//self._options.dt):
+            self._close_wav_writer()
             self._start_ts = now
             self._start_time = time.time()
-            # Write a static WAV header
-            with open(self._get_output_filename(), 'wb') as fp:
-                _write_wav_header(fp, 100, int(self._output_sample_rate), self._num_channels, self._options.is_kiwi_wav)
+            self._wav_writer = KiwiWavWriter(self._get_output_filename(), int(self._output_sample_rate), self._num_channels,
+                                             self._options.is_kiwi_wav, self._options.wav_header_interval)
             if self._options.is_kiwi_tdoa:
-                # NB: MUST be a print (i.e. not a logging.info)
-                print("file=%d %s" % (self._options.idx, self._get_output_filename()))
+                # NB: MUST go to stdout (i.e. not a logging.info), as one write
+                # since other threads/processes print their file names too
+                sys.stdout.write("file=%d %s\n" % (self._options.idx, self._get_output_filename()))
+                sys.stdout.flush()
             else:
                 logging.info("Started a new file: %s" % self._get_output_filename())
-        with open(self._get_output_filename(), 'ab') as fp:
-            if self._options.is_kiwi_wav:
-                gps = args[0]
-                logging.info('%s: last_gps_solution=%d gpssec=(%d,%d)' % (self._get_output_filename(), gps['last_gps_solution'], gps['gpssec'], gps['gpsnsec']));
-                fp.write(struct.pack('<4sIBBII', b'kiwi', 10, gps['last_gps_solution'], 0, gps['gpssec'], gps['gpsnsec']))
-                sample_size = samples.itemsize * len(samples)
-                fp.write(struct.pack('<4sI', b'data', sample_size))
-            # TODO: something better than that
-            samples.tofile(fp)
-        self._update_wav_header()
+        if self._options.is_kiwi_wav:
+            logging.info('%s: last_gps_solution=%d gpssec=(%d,%d)' % (self._get_output_filename(), gps['last_gps_solution'], gps['gpssec'], gps['gpsnsec']));
+        self._wav_writer.write(samples, gps)
+        self._num_blocks += 1
+        self._num_bytes  += samples.nbytes
+
+    def close(self):
+        self._close_file()
+        if self._writer_queue is not None:
+            self._writer_queue.close()
+        super(KiwiSoundRecorder, self).close()
 
     def _on_gnss_position(self, pos):
         pos_record = False
@@ -269,9 +552,61 @@ class KiwiWaterfallRecorder(KiwiSDRStream):
         #logging.info "%s:%s freq=%d" % (options.server_host, options.server_port, freq)
         self._freq = freq
         self._start_ts = None
+        self._start_time = None
 
         self._num_channels = 2 if options.modulation == 'iq' else 1
         self._last_gps = dict(zip(['last_gps_solution', 'dummy', 'gpssec', 'gpsnsec'], [0,0,0,0]))
+        self._num_lines = 0
+        self._archive = None
+        self._num_archives = 0
+
+    def stats(self):
+        return {'lines': self._num_lines}
+
+    def _get_output_filename(self):
+        station = '' if self._options.station is None else '_'+ self._options.station
+
+        # if multiple connections specified but not distinguished via --station then use index
+        if self._options.multiple_connections and self._options.station is None:
+            station = '_%d' % self._options.idx
+        if self._options.filename != '':
+            ## a fixed file name gets a counter for each following archive
+            part = '' if self._num_archives == 0 else '.%d' % self._num_archives
+            filename = '%s%s%s.kwf' % (self._options.filename, station, part)
+        else:
+            ts  = time.strftime('%Y%m%dT%H%M%SZ', self._start_ts)
+            filename = '%s_%d%s_wf.kwf' % (ts, int(self._freq * 1000), station)
+        if self._options.dir is not None:
+            filename = '%s/%s' % (self._options.dir, filename)
+        return filename
+
+    def _archive_line(self, seq, samples):
+        """Append the line to the waterfall archive, starting a new file when
+        --dt-sec says so or when the number of bins changes"""
+        now = time.gmtime()
+        sec_of_day = lambda x: 3600*x.tm_hour + 60*x.tm_min + x.tm_sec
+        if self._archive is None or self._archive_nbins != len(samples) or (
+                self._options.filename == '' and self._options.dt != 0 and
+                sec_of_day(now)//self._options.dt != sec_of_day(self._start_ts)//self._options.dt):
+            self._close_archive()
+            self._start_ts = now
+            self._archive_nbins = len(samples)
+            filename = self._get_output_filename()
+            self._archive = KiwiWfArchiveWriter(filename, len(samples),
+                                                station=self._options.station or self._options.server_host)
+            self._num_archives += 1
+            logging.info("Started a new file: %s" % filename)
+        self._archive.write(time.time(), seq, self._wf_zoom, self._wf_flags, self._wf_start, samples)
+
+    def _close_archive(self):
+        if self._archive is not None:
+            self._archive.close()
+            self._archive = None
+        self._start_ts = None
+
+    def close(self):
+        self._close_archive()
+        super(KiwiWaterfallRecorder, self).close()
 
     def _setup_rx_params(self):
         self._set_zoom_start(0, 0)
@@ -283,23 +618,22 @@ class KiwiWaterfallRecorder(KiwiSDRStream):
         self.set_name(self._options.user)
 
     def _process_waterfall_samples(self, seq, samples):
-        nbins = len(samples)
-        bins = nbins-1
-        max = -1
-        min = 256
-        bmax = bmin = 0
-        i = 0
-        for s in samples:
-            if s > max:
-                max = s
-                bmax = i
-            if s < min:
-                min = s
-                bmin = i
-            i += 1
-        span = 30000
+        self._num_lines += 1
+        if self._start_time is None:
+            self._start_time = time.time()
+        stats = waterfall_stats(samples)
+        if stats is None:
+            logging.debug('wf: empty line seq=%d skipped' % seq)
+            return
+        if self._options.wf_archive:
+            self._archive_line(seq, samples)
         logging.info("wf samples %d bins %d..%d dB %.1f..%.1f kHz rbw %d kHz"
-              % (nbins, min-255, max-255, span*bmin/bins, span*bmax/bins, span/bins))
+              % (stats['nbins'], stats['min'], stats['max'], stats['f_min'], stats['f_max'], stats['rbw']))
+        if self._options.wf_stats:
+            ## NB: one write per record since other threads/processes print their records too
+            stats.update(idx=self._options.idx, host=self._options.server_host, seq=seq, ts=time.time())
+            sys.stdout.write(json.dumps(stats, sort_keys=True) + '\n')
+            sys.stdout.flush()
 
 def options_cross_product(options):
     """build a list of options according to the number of servers specified"""
@@ -332,6 +666,172 @@ def join_threads(snd, wf):
     [r._event.set() for r in wf]
     [t.join() for t in threading.enumerate() if t is not threading.currentThread()]
 
+def options_status(gopt, options):
+    if gopt.is_kiwi_tdoa:
+      for i,opt in enumerate(options):
+          # NB: MUST be a print (i.e. not a logging.info)
+          print("status=%d,%d" % (i, opt.status))
+
+def run_asyncio(options, snd, wf, run_event, start_delay=0):
+    """run all KiwiAsyncWorkers in one event loop, using the same launch delays as the threads"""
+    from kiwiasync import run_async_workers
+    for workers in (snd, wf):
+        delay = start_delay
+        for i,w in enumerate(workers):
+            if i != 0 and options[i-1].server_host == options[i].server_host:
+                delay += options[i].launch_delay
+            w.set_start_delay(delay)
+    try:
+        run_async_workers(snd + wf)
+    except KeyboardInterrupt:
+        run_event.clear()
+        print("KeyboardInterrupt: event loop successfully closed")
+
+def run_recorders(gopt, options, run_event, start_delay=0):
+    """start the recorders for the connections in options and wait until they have stopped;
+    the first one is started after start_delay sec"""
+    if gopt.use_asyncio:
+        from kiwiasync import KiwiAsyncWorker as KiwiWorker
+    else:
+        from kiwiworker import KiwiWorker
+
+    snd_recorders = []
+    if not gopt.waterfall or (gopt.waterfall and gopt.sound):
+        for i,opt in enumerate(options):
+            snd_recorders.append(KiwiWorker(args=(KiwiSoundRecorder(opt),opt,run_event)))
+
+    wf_recorders = []
+    if gopt.waterfall:
+        for i,opt in enumerate(options):
+            wf_recorders.append(KiwiWorker(args=(KiwiWaterfallRecorder(opt),opt,run_event)))
+
+    if gopt.use_asyncio:
+        run_asyncio(options, snd_recorders, wf_recorders, run_event, start_delay)
+        return snd_recorders + wf_recorders
+
+    try:
+        time.sleep(start_delay)
+        for i,r in enumerate(snd_recorders):
+            if opt.launch_delay != 0 and i != 0 and options[i-1].server_host == options[i].server_host:
+                time.sleep(opt.launch_delay)
+            r.start()
+            #logging.info("started sound recorder %d, tstamp=%d" % (i, options[i].tstamp))
+            logging.info("started sound recorder %d" % options[i].idx)
+
+        for i,r in enumerate(wf_recorders):
+            if i!=0 and options[i-1].server_host == options[i].server_host:
+                time.sleep(opt.launch_delay)
+            r.start()
+            logging.info("started waterfall recorder %d" % options[i].idx)
+
+        while run_event.is_set():
+            time.sleep(.1)
+
+    except KeyboardInterrupt:
+        run_event.clear()
+        join_threads(snd_recorders, wf_recorders)
+        print("KeyboardInterrupt: threads successfully closed")
+    except Exception as e:
+        print_exc()
+        run_event.clear()
+        join_threads(snd_recorders, wf_recorders)
+        print("Exception: threads successfully closed")
+    return snd_recorders + wf_recorders
+
+def _watch_parent(conn, run_event):
+    """stop the recorders of a shard when the parent process asks for it"""
+    while run_event.is_set():
+        if conn.poll(0.1) and conn.recv() == 'stop':
+            run_event.clear()
+
+def _run_shard(gopt, options, conn, start_delay):
+    """child process of run_sharded(): run the connections of one shard and
+    send (idx, status, stats) for each of them and the number of keepalives
+    sent back to the parent"""
+    ## Ctrl-C is handled by the parent, which sends 'stop' over the pipe
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    run_event = threading.Event()
+    run_event.set()
+    watcher = threading.Thread(target=_watch_parent, args=(conn, run_event))
+    watcher.daemon = True
+    watcher.start()
+    workers = run_recorders(gopt, options, run_event, start_delay)
+    run_event.clear()
+    [w.join() for w in workers if hasattr(w, 'join')]
+    conn.send(([(w._options.idx, w._options.status, w._recorder.stats()) for w in workers],
+               KiwiSDRStream.keepalive_scheduler.count()))
+    conn.close()
+
+def _stop_shards(procs):
+    for p,conn,shard in procs:
+        try:
+            conn.send('stop')
+        except (IOError, OSError):
+            pass
+
+def run_sharded(gopt, options):
+    """distribute the connections over gopt.workers processes, each running its
+    shard of connections as in the single process case; returns the number
+    of keepalives sent by all of them"""
+    import multiprocessing
+    n = min(gopt.workers, len(options))
+    shards = [options[k*len(options)//n:(k+1)*len(options)//n] for k in range(n)]
+    ## time at which each connection is started in the single process case,
+    ## so that connections to the same host in different shards stay staggered
+    start = [0]
+    for i in range(1, len(options)):
+        same_host = options[i-1].server_host == options[i].server_host
+        start.append(start[-1] + (options[i].launch_delay if same_host else 0))
+    procs = []
+    for k,shard in enumerate(shards):
+        parent_conn, child_conn = multiprocessing.Pipe()
+        p = multiprocessing.Process(target=_run_shard, args=(gopt, shard, child_conn, start[shard[0].idx]))
+        p.start()
+        logging.info("started worker process %d (pid %d) with connections %s"
+                     % (k, p.pid, ','.join(str(opt.idx) for opt in shard)))
+        procs.append((p, parent_conn, shard))
+
+    results = []
+    keepalives = 0
+    pending = list(procs)
+    stopping = False
+    while pending:
+        try:
+            for p,conn,shard in list(pending):
+                result = None
+                if conn.poll(0.1):
+                    try:
+                        result,count = conn.recv()
+                        keepalives += count
+                    except EOFError:
+                        p.join()
+                elif p.is_alive():
+                    continue
+                if result is None:
+                    ## the child exited without a result: its connections failed
+                    logging.error("worker process %d died (exitcode %s)" % (p.pid, p.exitcode))
+                    result = [(opt.idx, 1, {}) for opt in shard]
+                results.extend(result)
+                pending.remove((p,conn,shard))
+                ## as in the single process case, where the first recorder to
+                ## stop (e.g. with a bad password or a busy Kiwi) stops all of
+                ## them, a shard that is done stops the other shards
+                if not stopping:
+                    stopping = True
+                    _stop_shards(pending)
+        except KeyboardInterrupt:
+            stopping = True
+            _stop_shards(pending)
+            print("KeyboardInterrupt: stopping worker processes")
+    for p,conn,shard in procs:
+        p.join()
+
+    for idx,status,stats in results:
+        options[idx].status = status
+        logging.info("connection %d: status=%d %s"
+                     % (idx, status, ' '.join('%s=%s' % kv for kv in sorted(stats.items()))))
+    return keepalives
+
 def main():
     parser = OptionParser()
     parser.add_option('--log', '--log-level', '--log_level', type='choice',
@@ -425,6 +925,18 @@ def main():
                       default=False,
                       action='store_true',
                       help='Use wav file format including KIWI header (GPS time-stamps) only for IQ mode')
+    parser.add_option('--wav-header-interval', '--wav_header_interval',
+                      dest='wav_header_interval',
+                      type='float', default=1.0,
+                      help='Interval (sec) for flushing the output file and updating its WAV header (0 = after every block)')
+    parser.add_option('--writer-queue', '--writer_queue',
+                      dest='writer_queue',
+                      type='int', default=0,
+                      help='Write files in a separate thread, with a queue of this many blocks (0 = write in the receive thread)')
+    parser.add_option('--writer-overflow', '--writer_overflow', type='choice',
+                      dest='writer_overflow', default='block',
+                      choices=['block', 'drop-oldest', 'warn'],
+                      help='What to do when the writer queue is full: block(default)|drop-oldest|warn (drop new blocks)')
     parser.add_option('-r', '--resample',
                       dest='resample',
                       type='int', default=0,
@@ -434,6 +946,10 @@ def main():
                       default=False,
                       action='store_true',
                       help='Used when called by Kiwi TDoA extension')
+    parser.add_option('--keepalive-interval', '--keepalive_interval',
+                      dest='keepalive_interval',
+                      type='float', default=1.0,
+                      help='Minimum interval (sec) between keepalives sent on each connection')
     parser.add_option('--tlimit', '--time-limit',
                       dest='tlimit',
                       type='float', default=None,
@@ -462,11 +978,30 @@ def main():
                       default=False,
                       action='store_true',
                       help='Process waterfall data instead of audio')
+    parser.add_option('--wf-stats', '--wf_stats',
+                      dest='wf_stats',
+                      default=False,
+                      action='store_true',
+                      help='Print per-line waterfall statistics (levels, percentiles, occupancy) as JSON records')
+    parser.add_option('--wf-archive', '--wf_archive',
+                      dest='wf_archive',
+                      default=False,
+                      action='store_true',
+                      help='Append the waterfall lines to .kwf archive files (see kiwiwf.py), rotated according to --dt-sec')
     parser.add_option('--snd',
                       dest='sound',
                       default=False,
                       action='store_true',
                       help='Also process sound data when in waterfall mode')
+    parser.add_option('--asyncio',
+                      dest='use_asyncio',
+                      default=False,
+                      action='store_true',
+                      help='Run all connections in one asyncio event loop instead of one thread per connection (python>=3.7)')
+    parser.add_option('--workers',
+                      dest='workers',
+                      type='int', default=1,
+                      help='Distribute the connections over this many processes; as with one process, all connections stop when one of them stops')
     parser.add_option('--test-mode',
                       dest='test_mode',
                       default=False,
@@ -483,59 +1018,29 @@ def main():
     if options.log_level.upper() == 'DEBUG':
         gc.set_debug(gc.DEBUG_SAVEALL | gc.DEBUG_LEAK | gc.DEBUG_UNCOLLECTABLE)
 
-    run_event = threading.Event()
-    run_event.set()
+    KiwiSDRStream.keepalive_scheduler.set_interval(options.keepalive_interval)
 
     options.raw = False;
     gopt = options
     multiple_connections,options = options_cross_product(options)
+    for i,opt in enumerate(options):
+        opt.multiple_connections = multiple_connections;
+        opt.idx = i
 
-    snd_recorders = []
-    if not gopt.waterfall or (gopt.waterfall and gopt.sound):
-        for i,opt in enumerate(options):
-            opt.multiple_connections = multiple_connections;
-            opt.idx = i
-            snd_recorders.append(KiwiWorker(args=(KiwiSoundRecorder(opt),opt,run_event)))
+    if gopt.workers > 1:
+        keepalives = run_sharded(gopt, options)
+    else:
+        run_event = threading.Event()
+        run_event.set()
+        workers = run_recorders(gopt, options, run_event)
+        for w in workers:
+            if getattr(w._recorder, '_writer_queue', None) is not None:
+                logging.debug('connection %d writer: %s' % (w._options.idx, w._recorder._writer_queue.metrics()))
+        keepalives = KiwiSDRStream.keepalive_scheduler.count()
 
-    wf_recorders = []
-    if gopt.waterfall:
-        for i,opt in enumerate(options):
-            opt.multiple_connections = multiple_connections;
-            opt.idx = i
-            wf_recorders.append(KiwiWorker(args=(KiwiWaterfallRecorder(opt),opt,run_event)))
-
-    try:
-        for i,r in enumerate(snd_recorders):
-            if opt.launch_delay != 0 and i != 0 and options[i-1].server_host == options[i].server_host:
-                time.sleep(opt.launch_delay)
-            r.start()
-            #logging.info("started sound recorder %d, tstamp=%d" % (i, options[i].tstamp))
-            logging.info("started sound recorder %d" % i)
-
-        for i,r in enumerate(wf_recorders):
-            if i!=0 and options[i-1].server_host == options[i].server_host:
-                time.sleep(opt.launch_delay)
-            r.start()
-            logging.info("started waterfall recorder %d" % i)
-
-        while run_event.is_set():
-            time.sleep(.1)
-
-    except KeyboardInterrupt:
-        run_event.clear()
-        join_threads(snd_recorders, wf_recorders)
-        print("KeyboardInterrupt: threads successfully closed")
-    except Exception as e:
-        print_exc()
-        run_event.clear()
-        join_threads(snd_recorders, wf_recorders)
-        print("Exception: threads successfully closed")
-
-    if gopt.is_kiwi_tdoa:
-      for i,opt in enumerate(options):
-          # NB: MUST be a print (i.e. not a logging.info)
-          print("status=%d,%d" % (i, opt.status))
+    options_status(gopt, options)
 
+    logging.debug('keepalives sent: %d' % keepalives)
     logging.debug('gc %s' % gc.garbage)
 
 if __name__ == '__main__':
@@ -0,0 +1,136 @@
+## -*- python -*-
+
+## waterfall archive: fixed-width records of uint8 waterfall lines
+##
+## file layout (little-endian):
+##   header, 64 bytes: magic 'KIWIWF01', header size, number of bins,
+##                     span (kHz), creation time, station name
+##   records:          ts (f8, unix time), seq (u4), zoom (u2), flags (u2),
+##                     start (u4, x_bin of the server), nbins x u1 (dB+255)
+##
+## the number of records is given by the file size, so a file which is being
+## written (or was cut short by a crash) can be read up to its last complete
+## record
+
+import os
+import struct
+import time
+import numpy as np
+
+_MAGIC  = b'KIWIWF01'
+_header = struct.Struct('<8sIIdd32s')  ## magic, header size, nbins, span, created, station
+_record = struct.Struct('<dIHHI')      ## ts, seq, zoom, flags, start
+
+## number of waterfall bins at zoom 0 is nbins << MAX_ZOOM in units of x_bin
+MAX_ZOOM = 14
+
+
+def record_dtype(nbins):
+    """numpy dtype of one archive record"""
+    return np.dtype([('ts',    '<f8'),
+                     ('seq',   '<u4'),
+                     ('zoom',  '<u2'),
+                     ('flags', '<u2'),
+                     ('start', '<u4'),
+                     ('line',  'u1', (nbins,))])
+
+
+class KiwiWfArchiveWriter(object):
+    """Appends waterfall lines to an archive file.
+
+    Only the file's buffer is kept in memory, so memory use does not grow
+    with the length of the capture. The buffered records are flushed after
+    each line unless flush_interval (sec) is larger than zero.
+    """
+
+    def __init__(self, filename, nbins, span=30000, station='', flush_interval=0):
+        self._nbins = nbins
+        self._flush_interval = flush_interval
+        self._fp = open(filename, 'wb')
+        self._fp.write(_header.pack(_MAGIC, _header.size, nbins, span, time.time(),
+                                    station.encode('utf-8')[:32]))
+        self._last_flush = time.time()
+
+    def write(self, ts, seq, zoom, flags, start, line):
+        line = np.asarray(line, dtype=np.uint8)
+        if len(line) != self._nbins:
+            raise ValueError('waterfall line has %d bins, archive has %d' % (len(line), self._nbins))
+        self._fp.write(_record.pack(ts, seq & 0xffffffff, zoom, flags, start & 0xffffffff))
+        self._fp.write(line.tobytes())
+        if time.time() - self._last_flush >= self._flush_interval:
+            self._fp.flush()
+            self._last_flush = time.time()
+
+    def close(self):
+        if self._fp is None:
+            return
+        self._fp.close()
+        self._fp = None
+
+
+class KiwiWfArchive(object):
+    """Memory-mapped reader for waterfall archive files.
+
+    The fields ts, seq, zoom, flags, start (1D) and lines (2D, records x bins)
+    are views on the mapped file: nothing is read from disk until the data
+    are accessed, so e.g. archive.lines[i0:i1, b0:b1] only touches those
+    records.
+    """
+
+    def __init__(self, filename):
+        with open(filename, 'rb') as fp:
+            header = fp.read(_header.size)
+        if len(header) != _header.size or header[:8] != _MAGIC:
+            raise ValueError('%s: not a waterfall archive' % filename)
+        magic, header_size, self.nbins, self.span, self.created, station = _header.unpack(header)
+        self.station = station.rstrip(b'\0').decode('utf-8', 'replace')
+        dtype = record_dtype(self.nbins)
+        num_records = (os.path.getsize(filename) - header_size) // dtype.itemsize
+        if num_records > 0:
+            self._records = np.memmap(filename, dtype=dtype, mode='r',
+                                      offset=header_size, shape=(num_records,))
+        else:
+            self._records = np.zeros(0, dtype=dtype)
+        self.ts    = self._records['ts']
+        self.seq   = self._records['seq']
+        self.zoom  = self._records['zoom']
+        self.flags = self._records['flags']
+        self.start = self._records['start']
+        self.lines = self._records['line']
+
+    def __len__(self):
+        return len(self._records)
+
+    def time_index(self, t0=None, t1=None):
+        """Record index range [i0,i1) with t0 <= ts < t1"""
+        i0 = 0         if t0 is None else int(np.searchsorted(self.ts, t0, side='left'))
+        i1 = len(self) if t1 is None else int(np.searchsorted(self.ts, t1, side='left'))
+        return i0, i1
+
+    def frequencies(self, i):
+        """Frequencies (kHz) of the bins of record i"""
+        zoom, start = int(self.zoom[i]), int(self.start[i])
+        full = float(self.nbins << MAX_ZOOM)
+        return self.span*(start + np.arange(self.nbins)*2**(MAX_ZOOM-zoom)) / full
+
+    def bin_index(self, f0=None, f1=None, i=0):
+        """Bin index range [b0,b1) with f0 <= frequency (kHz) < f1 for record i"""
+        f  = self.frequencies(i)
+        b0 = 0          if f0 is None else int(np.searchsorted(f, f0, side='left'))
+        b1 = self.nbins if f1 is None else int(np.searchsorted(f, f1, side='left'))
+        return b0, b1
+
+    def select(self, t0=None, t1=None, f0=None, f1=None):
+        """Returns (ts, lines) for t0 <= ts < t1 and f0 <= frequency (kHz) < f1;
+        the frequency range is taken from the first selected record, i.e. zoom
+        and start are assumed not to change within the time range"""
+        i0, i1 = self.time_index(t0, t1)
+        if i0 >= i1:
+            return self.ts[i0:i1], self.lines[i0:i1]
+        b0, b1 = self.bin_index(f0, f1, i0)
+        return self.ts[i0:i1], self.lines[i0:i1, b0:b1]
+
+    def close(self):
+        """Drop the references to the mapping; it is unmapped once views
+        handed out by this object are gone as well"""
+        self.ts = self.seq = self.zoom = self.flags = self.start = self.lines = self._records = None
@@ -115,6 +115,8 @@ time = 0
 while time<length:
     # receive one msg from server
     tmp = mystream.receive_message()
+    if isinstance(tmp, memoryview):
+        tmp = tmp.tobytes() # binary messages are views of the receive buffer
     if "W/F" in tmp: # this is one waterfall line
         tmp = tmp[16:] # remove some header from each msg
         if options['verbosity']:
@@ -89,6 +89,11 @@ class InvalidUTF8Exception(Exception):
     pass
 
 
+# Initial size of the receive buffer used when the connection supports
+# recv_into.
+_RECEIVE_BUFFER_SIZE = 64 * 1024
+
+
 class StreamBase(object):
     """Base stream class."""
 
@@ -103,6 +108,18 @@ class StreamBase(object):
 
         self._request = request
 
+        # Receive buffer. When the connection provides recv_into, data is read
+        # in large chunks into a bytearray and receive_bytes returns
+        # memoryview slices of it. Bytes in [0, _receive_start) have been
+        # handed out and are never overwritten: when the buffer runs out of
+        # space a new one is allocated and only the unconsumed bytes are
+        # moved, so the returned views stay valid.
+        self._receive_buffer = None
+        self._receive_start = 0
+        self._receive_end = 0
+        if hasattr(request.connection, 'recv_into'):
+            self._receive_buffer = bytearray(_RECEIVE_BUFFER_SIZE)
+
     def _read(self, length):
         """Reads length bytes from connection. In case we catch any exception,
         prepends remote address to the exception message and raise again.
@@ -146,14 +163,55 @@ class StreamBase(object):
                     e)
             raise
 
+    def _fill_receive_buffer(self, length):
+        """Makes sure at least length unconsumed bytes are in the receive
+        buffer, reading as much as the socket has available.
+
+        Raises:
+            ConnectionTerminatedException: when recv_into returns 0.
+        """
+
+        while self._receive_end - self._receive_start < length:
+            buffered = self._receive_end - self._receive_start
+            if len(self._receive_buffer) - self._receive_start < length:
+                new_buffer = bytearray(max(_RECEIVE_BUFFER_SIZE, 2 * length))
+                new_buffer[0:buffered] = self._receive_buffer[
+                    self._receive_start:self._receive_end]
+                self._receive_buffer = new_buffer
+                self._receive_start = 0
+                self._receive_end = buffered
+
+            view = memoryview(self._receive_buffer)[self._receive_end:]
+            try:
+                received = self._request.connection.recv_into(view)
+            except socket.error as e:
+                raise ConnectionTerminatedException(
+                    'Receiving %d byte failed. socket.error (%s) occurred' %
+                    (length - buffered, e))
+            if not received:
+                raise ConnectionTerminatedException(
+                    'Receiving %d byte failed. Peer (%r) closed connection' %
+                    (length - buffered,
+                     (self._request.connection.remote_addr,)))
+            self._receive_end += received
+
     def receive_bytes(self, length):
         """Receives multiple bytes. Retries read when we couldn't receive the
         specified amount.
 
+        When the connection supports recv_into, the bytes are served from the
+        receive buffer as a memoryview which stays valid after later reads.
+
         Raises:
             ConnectionTerminatedException: when read returns empty string.
         """
 
+        if self._receive_buffer is not None:
+            self._fill_receive_buffer(length)
+            start = self._receive_start
+            self._receive_start += length
+            return memoryview(self._receive_buffer)[start:start + length]
+
         read_bytes = []
         while length > 0:
             new_read_bytes = self._read(length)
@@ -172,6 +230,22 @@ class StreamBase(object):
             ConnectionTerminatedException: when read returns empty string.
         """
 
+        if self._receive_buffer is not None:
+            delim = bytearray(delim_char, 'latin-1') \
+                if not isinstance(delim_char, (bytes, bytearray)) \
+                else delim_char
+            scanned = 0
+            while True:
+                index = self._receive_buffer.find(
+                    delim, self._receive_start + scanned, self._receive_end)
+                if index >= 0:
+                    break
+                scanned = self._receive_end - self._receive_start
+                self._fill_receive_buffer(scanned + 1)
+            read_bytes = bytes(self._receive_buffer[self._receive_start:index])
+            self._receive_start = index + 1
+            return read_bytes
+
         read_bytes = []
         while True:
             ch = self._read(1)
@@ -59,6 +59,16 @@ from mod_pywebsocket._stream_base import UnsupportedFrameException
 _NOOP_MASKER = util.NoopMasker()
 
 
+def _to_bytes(data):
+    """Copies a payload served as a memoryview of the receive buffer into a
+    bytes object, for data which is kept or decoded.
+    """
+
+    if isinstance(data, memoryview):
+        return data.tobytes()
+    return data
+
+
 class Frame(object):
 
     def __init__(self, fin=1, rsv1=0, rsv2=0, rsv3=0,
@@ -460,6 +470,8 @@ class Stream(StreamBase):
 
     def _receive_frame_as_frame_object(self):
         opcode, unmasked_bytes, fin, rsv1, rsv2, rsv3 = self._receive_frame()
+        if common.is_control_opcode(opcode):
+            unmasked_bytes = _to_bytes(unmasked_bytes)
 
         return Frame(fin=fin, rsv1=rsv1, rsv2=rsv2, rsv3=rsv3,
                      opcode=opcode, payload=unmasked_bytes)
@@ -571,13 +583,13 @@ class Stream(StreamBase):
 
             if frame.fin:
                 # End of fragmentation frame
-                self._received_fragments.append(frame.payload)
-                message = ''.join(self._received_fragments)
+                self._received_fragments.append(_to_bytes(frame.payload))
+                message = b''.join(self._received_fragments)
                 self._received_fragments = []
                 return message
             else:
                 # Intermediate frame
-                self._received_fragments.append(frame.payload)
+                self._received_fragments.append(_to_bytes(frame.payload))
                 return None
         else:
             if self._received_fragments:
@@ -603,7 +615,7 @@ class Stream(StreamBase):
                         'Control frames must not be fragmented')
 
                 self._original_opcode = frame.opcode
-                self._received_fragments.append(frame.payload)
+                self._received_fragments.append(_to_bytes(frame.payload))
                 return None
 
     def _process_close_message(self, message):
@@ -785,7 +797,7 @@ class Stream(StreamBase):
                 # characters must be replaced with U+fffd REPLACEMENT
                 # CHARACTER.
                 try:
-                    return message.decode('utf-8')
+                    return _to_bytes(message).decode('utf-8')
                 except UnicodeDecodeError as e:
                     raise InvalidUTF8Exception(e)
             elif self._original_opcode == common.OPCODE_BINARY:
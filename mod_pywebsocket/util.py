@@ -195,10 +195,34 @@ class RepeatedXorMasker(object):
                 (self._masking_key_index + len(s)) % len(self._masking_key))
         return masked_data
 
+    def _mask_using_int(self, s):
+        """Perform the mask via python long integers.
+
+        The whole buffer and a matching run of the masking key (rotated to
+        start at the current key index) are converted to integers and XORed
+        in one operation.
+        """
+        length = len(s)
+        masking_key = bytes(self._masking_key)
+        masking_key_size = len(masking_key)
+        masking_key_index = self._masking_key_index
+
+        key = masking_key[masking_key_index:] + masking_key[:masking_key_index]
+        key = (key * (length // masking_key_size + 1))[:length]
+        masked_data = (int.from_bytes(s, 'big') ^
+                       int.from_bytes(key, 'big')).to_bytes(length, 'big')
+
+        self._masking_key_index = (
+                (masking_key_index + length) % masking_key_size)
+        return masked_data
+
     def _mask_using_array(self, s):
         """Perform the mask via python."""
         result = array.array('B')
-        result.fromstring(bytes(s))
+        if hasattr(result, 'frombytes'):
+            result.frombytes(bytes(s))
+        else:
+            result.fromstring(bytes(s))
 
         # Use temporary local variables to eliminate the cost to access
         # attributes
@@ -215,10 +239,16 @@ class RepeatedXorMasker(object):
 
         self._masking_key_index = masking_key_index
 
+        if hasattr(result, 'tobytes'):
+            return result.tobytes()
         return result.tostring()
 
+    # Prefer the SWIG module, then whole-buffer XOR on integers (needs
+    # int.from_bytes, i.e. python3), then the per-byte loop.
     if 'fast_masking' in globals():
         mask = _mask_using_swig
+    elif hasattr(int, 'from_bytes'):
+        mask = _mask_using_int
     else:
         mask = _mask_using_array
 
@@ -61,6 +61,12 @@ import struct
 import math
 from array import array
 
+try:
+    import numpy
+    HAS_NUMPY = True
+except ImportError:
+    HAS_NUMPY = False
+
 
 _adam7 = ((0, 0, 8, 8),
           (4, 0, 8, 8),
@@ -100,6 +106,110 @@ class Error(Exception):
     pass
 
 
+def _paeth_predictor(a, b, c):
+    """
+    Vectorized Paeth predictor for signed integer arrays.
+    """
+    # http://www.w3.org/TR/PNG/#9Filter-type-4-Paeth
+    pa = numpy.abs(b - c)
+    pb = numpy.abs(a - c)
+    pc = numpy.abs(a + b - 2 * c)
+    return numpy.where((pa <= pb) & (pa <= pc), a, numpy.where(pb <= pc, b, c))
+
+
+def filter_scanlines(pixels, psize, filter_type=0, previous=None):
+    """
+    Filter the rows of a 2-D uint8 numpy array for an 8-bit image.
+
+    psize is the number of bytes per pixel and previous the unfiltered
+    scanline above the first row, if any. filter_type is one of the PNG
+    filter types 0-4, used for all rows, or 'adaptive' to pick the
+    filter of each row by the minimum sum of absolute differences
+    heuristic of libpng.
+
+    Returns a 2-D uint8 array of scanlines, each preceded by its
+    filter type byte.
+    """
+    # http://www.w3.org/TR/PNG/#9Filters
+    height, row_bytes = pixels.shape
+    x = pixels.astype(numpy.int16)
+    b = numpy.zeros_like(x)
+    if previous is not None:
+        b[0] = previous
+    b[1:] = x[:-1]
+    a = numpy.zeros_like(x)
+    a[:, psize:] = x[:, :-psize]
+    c = numpy.zeros_like(x)
+    c[:, psize:] = b[:, :-psize]
+    filters = (lambda: x,
+               lambda: x - a,
+               lambda: x - b,
+               lambda: x - ((a + b) >> 1),
+               lambda: x - _paeth_predictor(a, b, c))
+    scanlines = numpy.empty((height, row_bytes + 1), dtype=numpy.uint8)
+    if filter_type == 'adaptive':
+        candidates = numpy.array([f() for f in filters]) & 0xff
+        # Residuals are scored as signed bytes, i.e. by distance from 0
+        scores = numpy.minimum(candidates, 256 - candidates).sum(axis=2)
+        types = numpy.argmin(scores, axis=0)
+        scanlines[:, 0] = types
+        scanlines[:, 1:] = candidates[types, numpy.arange(height)]
+    else:
+        scanlines[:, 0] = filter_type
+        scanlines[:, 1:] = filters[filter_type]() & 0xff
+    return scanlines
+
+
+def unfilter_scanlines(scanlines, row_bytes, psize):
+    """
+    Reverse the filtering of the scanlines of a non-interlaced image,
+    given as flat uint8 numpy data with each row preceded by its filter
+    type byte. Returns a 2-D uint8 array with one row per scanline.
+    """
+    rows = scanlines[:(len(scanlines) // (row_bytes + 1)) * (row_bytes + 1)]
+    rows = rows.reshape(-1, row_bytes + 1)
+    height = len(rows)
+    types = rows[:, 0]
+    if height and types.max() > 4:
+        raise Error("unknown filter type %d" % types.max())
+    if not numpy.any(types >= 3):
+        # Sub and up only depend on the current or the previous row
+        pixels = numpy.empty((height, row_bytes), dtype=numpy.uint8)
+        previous = numpy.zeros(row_bytes, dtype=numpy.uint8)
+        for y in range(height):
+            filter_type = types[y]
+            line = rows[y, 1:]
+            if filter_type == 1:
+                line = numpy.cumsum(line.reshape(-1, psize), axis=0,
+                                    dtype=numpy.uint8).reshape(-1)
+            elif filter_type == 2:
+                line = line + previous
+            pixels[y] = line
+            previous = pixels[y]
+        return pixels
+    # Average and Paeth need the reconstructed pixel to the left, so the
+    # image is reconstructed along anti-diagonals of pixels (y + x =
+    # const) which only depend on earlier diagonals. Row 0 and column 0
+    # of the padded result are the zero pixels outside the image.
+    width = row_bytes // psize
+    filtered = rows[:, 1:].reshape(height, width, psize).astype(numpy.int16)
+    pixels = numpy.zeros((height + 1, width + 1, psize), dtype=numpy.int16)
+    ys = numpy.arange(height)
+    zero = numpy.zeros((height, psize), dtype=numpy.int16)
+    for d in range(height + width - 1):
+        y0, y1 = max(0, d - width + 1), min(height, d + 1)
+        y = ys[y0:y1]
+        x = d - y
+        a = pixels[y + 1, x]
+        b = pixels[y, x + 1]
+        c = pixels[y, x]
+        predictor = numpy.choose(types[y0:y1, numpy.newaxis],
+                                 (zero[:y1 - y0], a, b, (a + b) >> 1,
+                                  _paeth_predictor(a, b, c)))
+        pixels[y + 1, x + 1] = (filtered[y, x] + predictor) & 0xff
+    return pixels[1:, 1:].reshape(height, row_bytes).astype(numpy.uint8)
+
+
 class Writer:
     """
     PNG encoder in pure Python.
@@ -114,7 +224,8 @@ class Writer:
                  bytes_per_sample=1,
                  compression=None,
                  interlaced=False,
-                 chunk_limit=2**20):
+                 chunk_limit=2**20,
+                 filter_type=0):
         """
         Create a PNG encoder object.
 
@@ -128,6 +239,13 @@ class Writer:
         bytes_per_sample - 8-bit or 16-bit input data
         compression - zlib compression level (1-9)
         chunk_limit - write multiple IDAT chunks to save memory
+        filter_type - PNG filter type (0-4) of all scanlines, or
+                      'adaptive' to choose the filter of each row
+
+        With numpy, 8-bit non-interlaced images are filtered and
+        packed in a vectorized way, and write() also accepts a 2-D
+        numpy array of rows. Without numpy, or for other images,
+        filter_type is ignored and the scanlines are written unfiltered.
 
         If specified, the transparent and background parameters must
         be a tuple with three integer values for red, green, blue, or
@@ -146,6 +264,9 @@ class Writer:
         if bytes_per_sample < 1 or bytes_per_sample > 2:
             raise ValueError("bytes per sample must be 1 or 2")
 
+        if filter_type not in (0, 1, 2, 3, 4, 'adaptive'):
+            raise ValueError("filter type must be 0-4 or 'adaptive'")
+
         if transparent is not None:
             if greyscale:
                 if type(transparent) is not int:
@@ -183,6 +304,7 @@ class Writer:
         self.compression = compression
         self.chunk_limit = chunk_limit
         self.interlaced = interlaced
+        self.filter_type = filter_type
 
         if self.greyscale:
             self.color_depth = 1
@@ -259,6 +381,19 @@ class Writer:
         else:
             compressor = zlib.compressobj()
 
+        if (HAS_NUMPY and self.bytes_per_sample == 1 and not self.interlaced
+            and (self.filter_type != 0 or isinstance(scanlines, numpy.ndarray))):
+            self.write_idat_numpy(outfile, compressor, scanlines)
+        else:
+            self.write_idat(outfile, compressor, scanlines)
+
+        # http://www.w3.org/TR/PNG/#11IEND
+        self.write_chunk(outfile, 'IEND', '')
+
+    def write_idat(self, outfile, compressor, scanlines):
+        """
+        Write unfiltered scanlines as IDAT chunks.
+        """
         data = array('B')
         for scanline in scanlines:
             data.append(0)
@@ -278,8 +413,33 @@ class Writer:
             # print >> sys.stderr, len(data), len(compressed), len(flushed)
             self.write_chunk(outfile, 'IDAT', compressed + flushed)
 
-        # http://www.w3.org/TR/PNG/#11IEND
-        self.write_chunk(outfile, 'IEND', '')
+    def write_idat_numpy(self, outfile, compressor, scanlines):
+        """
+        Filter 8-bit scanlines with numpy and write them as IDAT chunks.
+        The chunks are split as in write_idat(), so that the output is
+        the same for filter type 0.
+        """
+        row_bytes = self.width * self.psize
+        if not isinstance(scanlines, numpy.ndarray):
+            scanlines = list(scanlines)
+        pixels = numpy.asarray(scanlines, dtype=numpy.uint8)
+        pixels = pixels.reshape(self.height, row_bytes)
+        # write_idat() compresses as soon as more than chunk_limit bytes
+        # are buffered
+        block = self.chunk_limit // (row_bytes + 1) + 1
+        compressed = ''
+        for start in range(0, self.height, block):
+            previous = pixels[start - 1] if start else None
+            data = filter_scanlines(pixels[start:start+block], self.psize,
+                                    self.filter_type, previous)
+            compressed = compressor.compress(data.tobytes())
+            if len(data) == block:
+                if len(compressed):
+                    self.write_chunk(outfile, 'IDAT', compressed)
+                compressed = ''
+        flushed = compressor.flush()
+        if len(compressed) or len(flushed):
+            self.write_chunk(outfile, 'IDAT', compressed + flushed)
 
     def write_array(self, outfile, pixels):
         """
@@ -396,6 +556,122 @@ class Writer:
                     yield row
 
 
+class StreamWriter:
+    """
+    Non-interlaced 8-bit PNG encoder which is fed one or more rows at a
+    time, for images whose height is not known in advance.
+
+    The rows are compressed into a single zlib stream as they arrive;
+    the IDAT data is written and the height in IHDR patched by
+    commit(), which leaves a valid PNG of all rows so far in the file.
+    A commit only writes what was compressed since the previous one,
+    plus a short tail taken from a copy of the compressor, which is
+    overwritten by the next commit. close() terminates the stream.
+
+    filter_type is used as for Writer; without numpy the rows are
+    always written unfiltered.
+    """
+
+    def __init__(self, filename, width, greyscale=True, compression=None,
+                 filter_type=0):
+        if width <= 0:
+            raise ValueError("width must be greater than zero")
+        if filter_type not in (0, 1, 2, 3, 4, 'adaptive'):
+            raise ValueError("filter type must be 0-4 or 'adaptive'")
+        self.width = width
+        self.height = 0
+        self.color_type = 0 if greyscale else 2
+        self.psize = 1 if greyscale else 3
+        self.row_bytes = width * self.psize
+        self.filter_type = filter_type
+        # Last unfiltered row, for the filters referring to the row above
+        self._previous = None
+        if compression is not None:
+            self._compressor = zlib.compressobj(compression)
+        else:
+            self._compressor = zlib.compressobj()
+        self._pending = []
+        self._outfile = open(filename, 'w+b')
+        self._outfile.write(struct.pack("8B", 137, 80, 78, 71, 13, 10, 26, 10))
+        self._write_ihdr()
+        # Offset of the end of the committed IDAT chunks
+        self._data_end = self._outfile.tell()
+
+    def _write_chunk(self, tag, data):
+        checksum = zlib.crc32(data, zlib.crc32(tag)) & 0xffffffff
+        self._outfile.write(struct.pack("!I", len(data)) + tag + data +
+                            struct.pack("!I", checksum))
+
+    def _write_ihdr(self):
+        # http://www.w3.org/TR/PNG/#11IHDR
+        self._outfile.seek(8)
+        self._write_chunk(b'IHDR', struct.pack("!2I5B", self.width, self.height,
+                                               8, self.color_type, 0, 0, 0))
+
+    def write_rows(self, rows):
+        """
+        Append rows given as a bytes-like object of len(rows) a multiple
+        of the row size (width * 1 or 3 bytes).
+        """
+        rows = bytearray(rows)
+        n = len(rows) // self.row_bytes
+        if n * self.row_bytes != len(rows):
+            raise ValueError("data is not a whole number of rows")
+        if n == 0:
+            return
+        if HAS_NUMPY:
+            pixels = numpy.frombuffer(rows, dtype=numpy.uint8)
+            pixels = pixels.reshape(n, self.row_bytes)
+            data = filter_scanlines(pixels, self.psize, self.filter_type,
+                                    self._previous).tobytes()
+            self._previous = pixels[-1].copy()
+        else:
+            # Filter type 0 (None) for each scanline
+            data = bytearray((self.row_bytes + 1) * n)
+            for y in range(n):
+                offset = y * (self.row_bytes + 1)
+                data[offset+1:offset+1+self.row_bytes] = \
+                    rows[y*self.row_bytes:(y+1)*self.row_bytes]
+            data = bytes(data)
+        compressed = self._compressor.compress(data)
+        if len(compressed):
+            self._pending.append(compressed)
+        self.height += n
+
+    def _finish(self, tail):
+        self._outfile.seek(self._data_end)
+        if self._pending:
+            self._write_chunk(b'IDAT', b''.join(self._pending))
+        data_end = self._outfile.tell()
+        self._write_chunk(b'IDAT', tail)
+        self._write_chunk(b'IEND', b'')
+        self._outfile.truncate()
+        self._write_ihdr()
+        self._outfile.flush()
+        self._data_end = data_end
+        self._pending = []
+
+    def commit(self):
+        """
+        Update the file to a valid PNG of all rows written so far.
+        """
+        if self.height == 0:
+            return
+        self._finish(self._compressor.copy().flush())
+
+    def close(self):
+        """
+        Terminate the image and close the file. No image data is written
+        if there are no rows, as PNG does not allow a height of zero.
+        """
+        if self._outfile is None:
+            return
+        if self.height > 0:
+            self._finish(self._compressor.flush())
+        self._outfile.close()
+        self._outfile = None
+
+
 class _readable:
     """
     A simple file-like interface for strings and arrays.
@@ -670,6 +946,12 @@ class Reader:
         """
         Read pixel data without de-interlacing.
         """
+        if HAS_NUMPY:
+            pixels = unfilter_scanlines(
+                numpy.frombuffer(scanlines, dtype=numpy.uint8),
+                self.row_bytes, self.psize)
+            self.pixels = array('B', pixels.tobytes())
+            return self.pixels
         a = array('B')
         self.pixels = a
         offset = 0
@@ -1,43 +1,255 @@
 # -*- python -*-
 
-import collections
+## reader for KiwiSDR IQ .wav files with GNSS timestamps (kiwirecorder.py -m iq --kiwi-wav)
+##
+## the file is scanned once for its chunk headers, which gives an index with
+## one entry per kiwi/data chunk pair; the index is cached next to the file
+## (<filename>.idx.npz) and reused as long as the file's size and mtime do not
+## change. The sample data are memory-mapped, i.e. IQ samples are only read
+## from disk when they are accessed
+
+try:
+    from collections.abc import Iterator
+except ImportError:
+    from collections import Iterator
+import mmap
+import os
 import struct
 import numpy as np
-from chunk import Chunk
 
 class KiwiIQWavError(Exception):
     pass
 
-class KiwiIQWavReader(collections.Iterator):
-    def __init__(self, f):
+INDEX_VERSION = 1
+
+## one entry per kiwi/data chunk pair
+##  offset:       byte offset of the IQ samples in the file
+##  sample_start: number of IQ samples in the preceding blocks
+INDEX_DTYPE = np.dtype([('last_gps_solution', 'u1'),
+                        ('gpssec',            '<u4'),
+                        ('gpsnsec',           '<u4'),
+                        ('offset',            '<i8'),
+                        ('nsamples',          '<u4'),
+                        ('sample_start',      '<i8')])
+
+def _scan_kiwi_iq_wav(filename):
+    """Returns (samplerate, index) from a single pass over the chunk headers"""
+    with open(filename, 'rb') as f:
+        filesize = os.fstat(f.fileno()).st_size
+        if filesize < 12:
+            raise KiwiIQWavError('file does not start with RIFF id')
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        riff, riffsize, wave = struct.unpack_from('<4sI4s', buf, 0)
+        if riff != b'RIFF':
+            raise KiwiIQWavError('file does not start with RIFF id')
+        if wave != b'WAVE':
+            raise KiwiIQWavError('not a WAVE file')
+        if filesize < 20:
+            raise KiwiIQWavError('fmt chunk is missing')
+        name, size = struct.unpack_from('<4sI', buf, 12)
+        if name != b'fmt ' or size < 14 or filesize < 20+size:
+            raise KiwiIQWavError('fmt chunk is missing')
+        wFormatTag, nchannels, samplerate, dwAvgBytesPerSec, wBlockAlign = struct.unpack_from('<HHLLH', buf, 20)
+        if not (wFormatTag == 1 and nchannels == 2 and wBlockAlign == 4):
+            raise KiwiIQWavError('this is not a KiwiSDR IQ wav file')
+
+        ## the RIFF size in the header is only updated from time to time while
+        ## recording, so the chunks are scanned up to the end of the file;
+        ## an incomplete chunk pair at the end is ignored
+        entries = []
+        pos = 20 + size + (size & 1)
+        while pos + 8+10 + 8 <= filesize:
+            name, size = struct.unpack_from('<4sI', buf, pos)
+            if name != b'kiwi':
+                raise KiwiIQWavError('missing KiwiSDR GNSS time stamp')
+            last_gps_solution, dummy, gpssec, gpsnsec = struct.unpack_from('<BBII', buf, pos+8)
+            pos += 8 + size + (size & 1)
+            name, size = struct.unpack_from('<4sI', buf, pos)
+            if name != b'data':
+                raise KiwiIQWavError('missing WAVE data chunk')
+            if pos + 8 + size > filesize:
+                break
+            entries.append((last_gps_solution, gpssec, gpsnsec, pos+8, size//4, 0))
+            pos += 8 + size + (size & 1)
+    finally:
+        buf.close()
+
+    index = np.array(entries, dtype=INDEX_DTYPE)
+    if len(index):
+        index['sample_start'][1:] = np.cumsum(index['nsamples'][:-1], dtype=np.int64)
+    return samplerate, index
+
+## flags of KiwiIQTiming
+FLAG_NO_GPS  = 1 ## last_gps_solution 254/255: no recent GNSS solution
+FLAG_OUTLIER = 2 ## time stamp rejected by the fit
+
+class AffineTimes(object):
+    """Lazily evaluated time axis t[k] = t0 + k*dt, k=0..n-1.
+
+    Indexing with an integer returns a float, slicing returns another
+    AffineTimes; np.asarray() materializes the float64 time stamps.
+    """
+    def __init__(self, t0, dt, n):
+        self.t0 = t0
+        self.dt = dt
+        self._n = n
+
+    def __len__(self):
+        return self._n
+
+    def __getitem__(self, k):
+        if isinstance(k, slice):
+            start, stop, step = k.indices(self._n)
+            return AffineTimes(self.t0 + start*self.dt, step*self.dt, len(range(start, stop, step)))
+        if k < 0:
+            k += self._n
+        if not 0 <= k < self._n:
+            raise IndexError('time index out of range')
+        return self.t0 + k*self.dt
+
+    def __array__(self, dtype=None, copy=None):
+        t = self.t0 + np.arange(self._n, dtype=np.float64)*self.dt
+        return t if dtype is None else t.astype(dtype)
+
+class KiwiIQTiming(object):
+    """GNSS time of the IQ samples of a file, t = t0 + n/samplerate for the
+    n-th sample (counted over all blocks).
+
+    ref is an integer GNSS second which is subtracted from all time stamps
+    during the fit for numerical accuracy. Per block, residuals (sec) are the
+    differences between time stamp and fit, and flags the FLAG_* bits.
+    """
+    def __init__(self, ref, t0, samplerate, residuals, flags, index):
+        self.ref = ref
+        self.t0 = t0
+        self.samplerate = samplerate
+        self.residuals = residuals
+        self.flags = flags
+        self._sample_start = index['sample_start'].copy()
+        self._nsamples = index['nsamples'].copy()
+
+    def num_valid(self):
+        return int(np.count_nonzero(self.flags == 0))
+
+    def rms(self):
+        """RMS residual (sec) of the time stamps used in the fit"""
+        r = self.residuals[self.flags == 0]
+        return float(np.sqrt(np.mean(r*r))) if len(r) else float('nan')
+
+    def time(self, n):
+        """GNSS time of sample(s) n"""
+        return self.ref + (self.t0 + np.asarray(n, dtype=np.float64)/self.samplerate)
+
+    def sample_index(self, t):
+        """Index of the first sample at or after GNSS time t"""
+        return int(np.ceil(((t - self.ref) - self.t0)*self.samplerate - 1e-6))
+
+    def times(self, start, stop):
+        """Time stamps of the samples start..stop-1 as AffineTimes"""
+        return AffineTimes(float(self.time(start)), 1.0/self.samplerate, max(0, stop-start))
+
+    def block_times(self, i):
+        """Time stamps of the samples of block i as AffineTimes"""
+        start = int(self._sample_start[i])
+        return self.times(start, start + int(self._nsamples[i]))
+
+def solve_gnss_timing(index, samplerate, max_last_gps_solution=254,
+                      max_residual_samples=1.0, max_iter=10):
+    """Fits sample rate and offset to the GNSS time stamps of all blocks of
+    an index (see INDEX_DTYPE) by least squares, returns KiwiIQTiming.
+
+    Blocks with last_gps_solution >= max_last_gps_solution (254/255: no
+    recent GNSS solution) are not used. Outliers are removed iteratively:
+    the rejection threshold is 5 (scaled) MADs of the residuals, but never
+    smaller than max_residual_samples. Without at least two usable time
+    stamps the nominal sample rate is used.
+    """
+    x     = index['sample_start'].astype(np.float64)
+    flags = np.where(index['last_gps_solution'] >= max_last_gps_solution, FLAG_NO_GPS, 0).astype(np.uint8)
+    use   = flags == 0
+    ref   = int(index['gpssec'][np.argmax(use)]) if len(index) else 0
+    y     = (index['gpssec'].astype(np.int64) - ref) + 1e-9*index['gpsnsec']
+
+    tol = max_residual_samples/float(samplerate)
+    b = 1.0/samplerate
+    a = y[np.argmax(use)] - b*x[np.argmax(use)] if len(index) else 0.0
+    inliers = use.copy()
+    for _ in range(max_iter):
+        if np.count_nonzero(inliers) < 2:
+            break
+        xm, ym = np.mean(x[inliers]), np.mean(y[inliers])
+        dx = x[inliers] - xm
+        b  = np.dot(dx, y[inliers] - ym) / np.dot(dx, dx) if np.any(dx) else 1.0/samplerate
+        a  = ym - b*xm
+        r  = y - (a + b*x)
+        mad = 1.4826*np.median(np.abs(r[inliers] - np.median(r[inliers])))
+        keep = use & (np.abs(r) <= max(tol, 5*mad))
+        if np.array_equal(keep, inliers):
+            break
+        inliers = keep
+
+    residuals = y - (a + b*x)
+    flags[use & ~inliers] |= FLAG_OUTLIER
+    return KiwiIQTiming(ref, a, 1.0/b, residuals, flags, index)
+
+def _index_cache_filename(filename):
+    return filename + '.idx.npz'
+
+def load_kiwi_iq_wav_index(filename, use_cache=True):
+    """Returns (samplerate, index) for a Kiwi IQ wav file, see INDEX_DTYPE.
+    With use_cache the index is read from and written to <filename>.idx.npz"""
+    st = os.stat(filename)
+    meta = np.array([INDEX_VERSION, st.st_size, st.st_mtime], dtype=np.float64)
+    cache = _index_cache_filename(filename)
+    if use_cache and os.path.exists(cache):
+        try:
+            with np.load(cache) as c:
+                if np.array_equal(c['meta'], meta) and c['index'].dtype == INDEX_DTYPE:
+                    return int(c['samplerate']), c['index']
+        except Exception:
+            pass ## unreadable or stale cache: rebuild it
+
+    samplerate, index = _scan_kiwi_iq_wav(filename)
+    if use_cache:
+        tmp = '%s.%d.tmp' % (cache, os.getpid())
+        try:
+            with open(tmp, 'wb') as f:
+                np.savez(f, meta=meta, samplerate=samplerate, index=index)
+            os.rename(tmp, cache)
+        except (IOError, OSError):
+            ## e.g. a read-only directory: work without cache
+            if os.path.exists(tmp):
+                os.remove(tmp)
+    return samplerate, index
+
+class KiwiIQWavReader(Iterator):
+    """Indexed reader for KiwiSDR IQ wav files.
+
+    Iterating yields (t,z) per data chunk as before. In addition the blocks
+    can be accessed directly: index holds one entry per block (see
+    INDEX_DTYPE), block_iq(i) and iq_blocks(t0,t1) return zero-copy int16
+    views of shape (n,2) on the memory-mapped file.
+    """
+    def __init__(self, f, use_index_cache=True):
         super(KiwiIQWavReader, self).__init__()
         self._frame_counter = 0
         self._last_gpssec   = -1
-        try:
-            self._f = open(f, 'rb')
-            self._initfp(self._f)
-        except:
-            if self._f:
-                self._f.close()
-            raise
-
-    def __del__(self):
-        if self._f:
-            self._f.close()
-
-    def _initfp(self, file):
-        self._file = Chunk(file, bigendian = 0)
-        if self._file.getname() != b'RIFF':
-            raise KiwiIQWavError('file does not start with RIFF id')
-        if self._file.read(4) != b'WAVE':
-            raise KiwiIQWavError('not a WAVE file')
+        self._block         = 0
+        self._samplerate, self.index = load_kiwi_iq_wav_index(f, use_index_cache)
+        self._nominal_samplerate = self._samplerate
+        if len(self.index):
+            self._data = np.memmap(f, dtype='<i2', mode='r')
+        else:
+            self._data = np.zeros(0, dtype='<i2')
 
-        chunk = Chunk(self._file, bigendian = 0)
-        if chunk.getname() != b'fmt ':
-            raise KiwiIQWavError('fmt chunk is missing')
+    def __len__(self):
+        return len(self.index)
 
-        self._proc_chunk_fmt(chunk)
-        chunk.skip()
+    def close(self):
+        """Drop the reference to the mapping; it is unmapped once views
+        handed out by this object are gone as well"""
+        self._data = None
 
     ## for python3
     def __next__(self):
@@ -45,23 +257,14 @@ class KiwiIQWavReader(collections.Iterator):
 
     ## for python2
     def next(self):
-        try:
-            chunk = Chunk(self._file, bigendian = 0)
-            if chunk.getname() != b'kiwi':
-                raise KiwiIQWavError('missing KiwiSDR GNSS time stamp')
-
-            self._proc_chunk_kiwi(chunk)
-            chunk.skip()
-
-            chunk = Chunk(self._file, bigendian = 0)
-            if chunk.getname() != b'data':
-                raise KiwiIQWavError('missing WAVE data chunk')
-
-            tz = self._proc_chunk_data(chunk)
-            chunk.skip()
-            return tz
-        except EOFError:
+        if self._block >= len(self.index):
             raise StopIteration
+        e = self.index[self._block]
+        self.last_gps_solution = int(e['last_gps_solution'])
+        self.gpssec = int(e['gpssec']) + 1e-9*int(e['gpsnsec'])
+        tz = self._proc_chunk_data(self.block_iq(self._block))
+        self._block += 1
+        return tz
 
     def process_iq_samples(self, t,z):
         ## print(len(t), len(z))
@@ -70,17 +273,82 @@ class KiwiIQWavReader(collections.Iterator):
     def get_samplerate(self):
         return self._samplerate
 
-    def _proc_chunk_fmt(self, chunk):
-        wFormatTag, nchannels, self._samplerate, dwAvgBytesPerSec, wBlockAlign = struct.unpack('<HHLLH', chunk.read(chunk.getsize()-2))
-        assert wFormatTag == 1 and nchannels == 2 and wBlockAlign == 4, 'this is not a KiwiSDR IQ wav file'
+    def gpstime(self):
+        """GNSS time of the first sample of each block"""
+        return self.index['gpssec'] + 1e-9*self.index['gpsnsec']
+
+    def num_samples(self):
+        return int(self.index['sample_start'][-1] + self.index['nsamples'][-1]) if len(self.index) else 0
+
+    def block_iq(self, i):
+        """int16 IQ samples of block i, a (n,2) view on the file"""
+        e = self.index[i]
+        start = int(e['offset']) // 2
+        return self._data[start:start+2*int(e['nsamples'])].reshape(-1, 2)
+
+    def block_range(self, t0=None, t1=None):
+        """Block index range [i0,i1) of the blocks overlapping t0 <= t < t1 (GNSS time)"""
+        t  = self.gpstime()
+        i0 = 0         if t0 is None else max(0, int(np.searchsorted(t, t0, side='right')) - 1)
+        i1 = len(self) if t1 is None else int(np.searchsorted(t, t1, side='left'))
+        if t0 is not None and i0 < i1 and i0+1 == len(self):
+            ## the end of the last block is only known from the sample rate
+            if t[i0] + self.index['nsamples'][i0]/float(self._nominal_samplerate) <= t0:
+                i0 = i1
+        return i0, i1
+
+    def timing(self, **kwargs):
+        """Sample timing fitted to all GNSS time stamps, see solve_gnss_timing"""
+        return solve_gnss_timing(self.index, self._nominal_samplerate, **kwargs)
+
+    def samples(self, t0=None, t1=None, timing=None):
+        """Returns (t,z) for the samples with t0 <= t < t1 (GNSS time): t is
+        AffineTimes and z complex64 IQ samples"""
+        timing = timing if timing is not None else self.timing()
+        n  = self.num_samples()
+        n0 = 0 if t0 is None else min(max(timing.sample_index(t0), 0), n)
+        n1 = n if t1 is None else min(max(timing.sample_index(t1), n0), n)
+        return timing.times(n0, n1), self.read_iq(n0, n1)
+
+    def read_iq(self, n0, n1, out=None):
+        """complex64 IQ samples n0..n1-1 (counted over all blocks), written
+        to out if given, e.g. a memory-mapped output file"""
+        z = np.empty(max(0, n1-n0), dtype=np.complex64) if out is None else out
+        if n0 >= n1:
+            return z
+        start = self.index['sample_start']
+        for i in range(int(np.searchsorted(start, n0, side='right'))-1,
+                       int(np.searchsorted(start, n1, side='left'))):
+            s  = int(start[i])
+            b0 = max(n0, s)
+            b1 = min(n1, s + int(self.index['nsamples'][i]))
+            self._iq_to_complex(self.block_iq(i)[b0-s:b1-s], z[b0-n0:b1-n0])
+        return z
+
+    def iq_blocks(self, t0=None, t1=None):
+        """Zero-copy int16 views (n,2) of the blocks overlapping t0 <= t < t1"""
+        i0, i1 = self.block_range(t0, t1)
+        return [self.block_iq(i) for i in range(i0, i1)]
+
+    def iq(self, t0=None, t1=None):
+        """complex64 IQ samples (scaled as in iteration) of the blocks overlapping t0 <= t < t1"""
+        i0, i1 = self.block_range(t0, t1)
+        if i0 >= i1:
+            return np.zeros(0, dtype=np.complex64)
+        return self.read_iq(int(self.index['sample_start'][i0]),
+                             int(self.index['sample_start'][i1-1] + self.index['nsamples'][i1-1]))
 
-    def _proc_chunk_kiwi(self, chunk):
-        self.last_gps_solution,dummy,gpssec,gpsnsec = struct.unpack('<BBII', chunk.read(10))
-        self.gpssec = gpssec + 1e-9*gpsnsec
+    @staticmethod
+    def _iq_to_complex(iq, out=None):
+        if out is None:
+            out = np.empty(len(iq), dtype=np.complex64)
+        f = out.view(np.float32).reshape(-1, 2)
+        np.multiply(iq, np.float32(1/65535.), out=f, casting='unsafe')
+        return out
 
-    def _proc_chunk_data(self, chunk):
+    def _proc_chunk_data(self, iq, z=None):
         t = None
-        z = np.frombuffer(chunk.read(chunk.getsize()), dtype=np.int16).astype(np.float32).view(np.complex64)/65535
+        z = self._iq_to_complex(iq, z)
         n = len(z)
         if self._last_gpssec >= 0:
             if self._frame_counter < 3:
@@ -89,11 +357,8 @@ class KiwiIQWavReader(collections.Iterator):
                 self._samplerate = 0.9*self._samplerate + 0.1*n/(self.gpssec - self._last_gpssec)
 
         if self._frame_counter >= 2:
-            t = np.arange(start = self.gpssec,
-                          stop  = self.gpssec + (n-0.5)/self._samplerate,
-                          step  = 1/self._samplerate,
-                          dtype = np.float64)
-            ##t = self.gpssec + np.array(range(n))/self._samplerate
+            ## from the integer sample index, so that len(t) == len(z) always
+            t = self.gpssec + np.arange(n, dtype=np.float64)/self._samplerate
             self.process_iq_samples(t,z)
 
         self._last_gpssec = self.gpssec;
@@ -101,14 +366,22 @@ class KiwiIQWavReader(collections.Iterator):
         return t,z
 
 def read_kiwi_iq_wav(filename):
-    t = []
-    z = []
-    for _t,_z in KiwiIQWavReader(filename):
+    ## the output arrays are allocated once from the index instead of
+    ## concatenating the blocks at the end
+    r = KiwiIQWavReader(filename)
+    skip = min(2, len(r)) ## the first two blocks have no timestamps
+    n = r.num_samples() - int(np.sum(r.index['nsamples'][:skip], dtype=np.int64))
+    t = np.empty(n, dtype=np.float64)
+    z = np.empty(n, dtype=np.complex64)
+    pos = 0
+    for _t,_z in r:
         if _t is None:
             continue
-        t.append(_t)
-        z.append(_z)
-    return np.concatenate(t), np.concatenate(z)
+        m = len(_z)
+        t[pos:pos+m] = _t
+        z[pos:pos+m] = _z
+        pos += m
+    return t, z
 
 if __name__ == '__main__':
     import sys
@@ -117,3 +390,8 @@ if __name__ == '__main__':
 
     [t,z]=read_kiwi_iq_wav(sys.argv[1])
     print (len(t),len(z), t[-1], z[-1], (t[-1]-t[-2])*1e6)
+    timing = KiwiIQWavReader(sys.argv[1]).timing()
+    print ('fs=%.4f Hz blocks: %d valid, %d without GNSS, %d outliers; rms=%.2f us'
+           % (timing.samplerate, timing.num_valid(),
+              np.count_nonzero(timing.flags & FLAG_NO_GPS),
+              np.count_nonzero(timing.flags & FLAG_OUTLIER), timing.rms()*1e6))
@@ -0,0 +1,46 @@
+## -*- python -*-
+
+## microbenchmark for mod_pywebsocket.util.RepeatedXorMasker
+##  * compares the available masking implementations on typical message sizes
+##  * checks that all of them produce the same output, also when the masking
+##    key index is carried across several mask() calls
+##  * run from the top-level directory: python test/bench_masking.py
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from mod_pywebsocket import util
+
+METHODS = [name for name in ('_mask_using_swig', '_mask_using_int', '_mask_using_array')
+           if name != '_mask_using_swig' or 'fast_masking' in util.__dict__]
+
+def run_method(name, key, chunks):
+    masker = util.RepeatedXorMasker(key)
+    return b''.join(bytes(getattr(masker, name)(c)) for c in chunks)
+
+def check(key):
+    chunks = [os.urandom(n) for n in (0, 1, 3, 7, 125, 1000)]
+    results = [run_method(name, key, chunks) for name in METHODS]
+    assert all(r == results[0] for r in results), 'masking methods disagree'
+
+def main():
+    key = os.urandom(4)
+    check(key)
+    print('default method: %s' % util.RepeatedXorMasker.mask.__name__)
+    ## 'SET keepalive'-sized, SET command, SND frame, large IQ frame
+    for size in (13, 64, 1024, 65536):
+        data = os.urandom(size)
+        line = []
+        for name in METHODS:
+            masker = util.RepeatedXorMasker(key)
+            fn = getattr(masker, name)
+            n = max(10, 2000000 // (size * (100 if name == '_mask_using_array' else 1)))
+            t = timeit.timeit(lambda: fn(data), number=n) / n
+            line.append('%s %9.2f us' % (name[len('_mask_using_'):], 1e6*t))
+        print('%6d bytes: %s' % (size, '  '.join(line)))
+
+if __name__ == '__main__':
+    main()
@@ -411,6 +411,9 @@ class ClientConnection(object):
     def read(self, n):
         return self._socket.recv(n)
 
+    def recv_into(self, buf):
+        return self._socket.recv_into(buf)
+
     def get_remote_addr(self):
         return self._socket.getpeername()
     remote_addr = property(get_remote_addr)